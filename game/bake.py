@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright Tom SF Haines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+# Offline precomputation for levels - run after editing a level so the game does not have to do the work at load time, e.g. python bake.py cull data/levels/test/things.egg Bad level geometry is reported here, rather than in the middle of a transition...
+
+import sys
+import glob
+import posixpath
+import argparse
+import xml.etree.ElementTree as et
+
+from panda3d.core import loadPrcFile
+loadPrcFile('config/settings.prc')
+from panda3d.core import *
+
+from plugins.cullaabb.cullcache import *
+from bin.shared import odeSpaceHier
+
+
+
+def loadModel(filename):
+  """Loads a model without needing a ShowBase, returning a NodePath."""
+  node = Loader.getGlobalPtr().loadSync(Filename.fromOsSpecific(filename))
+  if node==None:
+    raise IOError('Could not load %s'%filename)
+  return NodePath(node)
+
+
+def bakeCull(args):
+  """Calculates the culling structure of each given things file, writing it to a cache file alongside it. Optionally includes the potentially visible sets."""
+  files = args.files
+  if len(files)==0:
+    files = sorted(glob.glob('data/levels/*/*things.egg*'))
+
+  failed = 0
+  for filename in files:
+    print 'Baking culling for', filename
+    try:
+      data = CullData()
+      data.calculate(loadModel(filename).findAllMatches('**/=IsA=CullAABB'))
+      if args.pvs:
+        data.calculateVisibility(args.samples,args.depth)
+        counts = map(lambda b: bin(b).count('1'),data.pvs)
+        print '  potentially visible cells per cell: %.1f mean, %i max'%(sum(counts)/float(max(len(counts),1)),max(counts+[0]))
+      data.save(cacheFilename(filename),fileHash(filename))
+      print '  %i cells, %i portals, kd tree %s'%(len(data.bounds),len(data.portals),data.kd.stats())
+    except Exception, e:
+      print '  Failed:', e
+      failed += 1
+  return failed
+
+
+
+def configPaths():
+  """Returns the paths configured by the Global paths object in base.xml, as a dictionary."""
+  ret = dict()
+  for obj in et.parse('config/base.xml').findall('obj'):
+    if obj.get('name')=='paths':
+      for elem in obj:
+        ret[elem.tag] = elem.get('path')
+  return ret
+
+
+def bakeCollision(args):
+  """Clusters the triangles of level collision files, writing them to the cache directory where Level will find them. By default does every collision file used by a Level in the configs, with the triangle count it uses."""
+  paths = configPaths()
+  cacheDir = args.cache or paths['cache']
+
+  # Get the list of (filename,target triangles) to do...
+  todo = []
+  if len(args.files)!=0:
+    todo = map(lambda f: (f,args.triangles),args.files)
+  else:
+    for config in sorted(glob.glob('config/*.xml')):
+      for obj in et.parse(config).findall('obj'):
+        collide = obj.find('collide')
+        if obj.get('type')=='Level' and collide!=None and collide.get('layout','balanced')!='egg':
+          path = findModelFile(posixpath.join(paths['levels'],collide.get('filename')))
+          job = (path,int(collide.get('triangles',args.triangles)))
+          if path!=None and job not in todo:
+            todo.append(job)
+
+  failed = 0
+  for filename,target in todo:
+    print 'Baking collision for', filename
+    try:
+      for r in odeSpaceHier.balancedClusters(loadModel(filename),target):
+        clusters = r
+      if clusters==None:
+        print '  Nothing to collide with'
+        continue
+      cacheFile = odeSpaceHier.clusterCacheFile(cacheDir,filename,target)
+      if not odeSpaceHier.saveClusters(clusters,cacheFile):
+        raise IOError('Could not write %s'%cacheFile)
+      print '  %i clusters, written to %s'%(clusters.getNumChildren(),cacheFile)
+    except Exception, e:
+      print '  Failed:', e
+      failed += 1
+  return failed
+
+
+
+parser = argparse.ArgumentParser(description='Offline precomputation for levels.')
+sub = parser.add_subparsers()
+
+cull = sub.add_parser('cull', help='Bake the culling cells, portals and kd tree of levels.')
+cull.add_argument('files', nargs='*', help='Level things files - defaults to every one in data/levels.')
+cull.add_argument('--pvs', action='store_true', help='Also precalculate the potentially visible set of each cell, for CullAABB in pvs mode.')
+cull.add_argument('--samples', type=int, default=3, help='Viewpoints sampled along each axis of a cell when calculating visible sets.')
+cull.add_argument('--depth', type=int, default=32, help='Maximum number of portals to look through when calculating visible sets.')
+cull.set_defaults(func=bakeCull)
+
+collision = sub.add_parser('collision', help='Bake the clustered collision geometry of levels.')
+collision.add_argument('files', nargs='*', help='Level collision files - defaults to every one used by a Level in the configs.')
+collision.add_argument('--triangles', type=int, default=256, help='Target triangles per cluster, when not given by the config.')
+collision.add_argument('--cache', help='Cache directory - defaults to the one in the paths config.')
+collision.set_defaults(func=bakeCollision)
+
+if __name__=='__main__':
+  args = parser.parse_args()
+  if args.func(args)!=0:
+    sys.exit(1)
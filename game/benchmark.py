@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright Tom SF Haines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+# Headless benchmark - loads a config into an offscreen buffer, runs a fixed number of simulated frames with scripted input and prints the timings as json. Intended for regression numbers on machines without a GPU, e.g. python benchmark.py test --seconds 20 --software
+# Also has a mode for timing the portal finding of the culling system on generated levels, e.g. python benchmark.py --portals 1000 10000
+
+import sys
+import json
+import argparse
+
+
+# Default input script - (time in seconds,event) pairs, repeated for the length of the run. Walks about, looks around by strafing, jumps and shoots...
+defaultScript = [(0.5,'w'),(3.0,'w-up'),(3.0,'d'),(4.5,'d-up'),(5.0,'mouse1'),(5.2,'mouse1-up'),(5.5,'space'),(6.0,'s'),(8.0,'s-up'),(8.0,'a'),(9.5,'a-up'),(10.0,'mouse1'),(10.2,'mouse1-up')]
+scriptLength = 10.5
+
+
+parser = argparse.ArgumentParser(description='Runs a config headless with scripted input, printing timings as json.')
+parser.add_argument('config', nargs='?', help='Config to load, e.g. cove, beach or test.')
+parser.add_argument('--seconds', type=float, default=10.0, help='Simulated seconds to run for once loaded.')
+parser.add_argument('--fps', type=float, default=30.0, help='Simulated frame rate - every frame advances the clock by 1/fps, regardless of how long it really took.')
+parser.add_argument('--window', choices=['offscreen','onscreen'], default='offscreen', help='What to render into.')
+parser.add_argument('--software', action='store_true', help='Use the software renderer, for machines without a GPU.')
+parser.add_argument('--script', help='json file containing a list of [time,event] pairs to use as input instead of the default.')
+parser.add_argument('--output', help='File to write the json to, in addition to printing it.')
+parser.add_argument('--portals', type=int, nargs='+', metavar='CELLS', help='Instead of running a config time the culling portal finder on generated grids of rooms and connecting corridors, with roughly the given numbers of cells.')
+args = parser.parse_args()
+if args.config==None and args.portals==None:
+  parser.error('Either a config or --portals is required.')
+
+
+def output(results):
+  """Prints the results as json, also writing them to the output file if requested."""
+  out = json.dumps(results,indent=2,sort_keys=True)
+  print out
+  if args.output!=None:
+    f = open(args.output,'w')
+    f.write(out+'\n')
+    f.close()
+
+
+def portalGrid(cells):
+  """Returns a list of AABB's for a square grid of rooms, each connected to its neighbours by a corridor that pokes into both - about 3 cells per room."""
+  from plugins.cullaabb.aabb import AABB
+  n = max(int(round((cells/3.0)**0.5)),1)
+  ret = []
+  for i in xrange(n):
+    for j in xrange(n):
+      ret.append(AABB((i*12.0,j*12.0,0.0),(i*12.0+10.0,j*12.0+10.0,5.0)))
+      if i+1<n: ret.append(AABB((i*12.0+9.5,j*12.0+4.0,1.0),(i*12.0+12.5,j*12.0+6.0,3.0)))
+      if j+1<n: ret.append(AABB((i*12.0+4.0,j*12.0+9.5,1.0),(i*12.0+6.0,j*12.0+12.5,3.0)))
+  return ret
+
+
+if args.portals!=None:
+  import time
+  from plugins.cullaabb.aabb import findPortals, SetAABB
+
+  results = {'portals':[]}
+  for cells in args.portals:
+    aabbs = portalGrid(cells)
+    start = time.time()
+    portals = findPortals(aabbs)
+    mid = time.time()
+    kd = SetAABB(aabbs)
+    end = time.time()
+    results['portals'].append({'cells':len(aabbs), 'portals':len(portals), 'findPortals':mid-start, 'kdBuild':end-mid, 'kdStats':kd.stats()})
+  output(results)
+  sys.exit()
+
+
+# Configure Panda before anything else touches it...
+from panda3d.core import loadPrcFile, loadPrcFileData
+loadPrcFile('config/settings.prc')
+loadPrcFileData('benchmark', 'window-type none\nsync-video #f\naudio-library-name null')
+if args.software:
+  loadPrcFileData('benchmark-software', 'load-display p3tinydisplay\nframebuffer-multisample #f\nmultisamples 0')
+
+from panda3d.core import ClockObject
+from direct.showbase.ShowBase import ShowBase
+from direct.task import Task
+
+from bin.manager import *
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+
+base = ShowBase()
+base.windowType = args.window # So when the Window plugin opens the window it gets what we asked for.
+
+if args.script!=None:
+  try:
+    f = open(args.script,'r')
+    try:
+      script = json.load(f)
+    finally:
+      f.close()
+  except (IOError,ValueError), e:
+    parser.error('Could not read --script: %s'%e)
+
+  # Must be a non-empty list of [time,event] pairs, played in time order...
+  def isPair(s):
+    return isinstance(s,list) and len(s)==2 and isinstance(s[0],(int,long,float)) and not isinstance(s[0],bool) and s[0]>=0.0 and isinstance(s[1],basestring)
+  if not isinstance(script,list) or len(script)==0 or not all(map(isPair,script)):
+    parser.error('--script must be a non-empty json list of [time,event] pairs, with non-negative times and string events.')
+  script = sorted(map(tuple,script))
+  length = max(map(lambda s: s[0],script)) + 0.5
+else:
+  script = defaultScript
+  length = scriptLength
+
+plugin = Manager()
+results = {'config':args.config, 'fps':args.fps, 'seconds':args.seconds, 'window':args.window, 'software':args.software}
+frameTimes = []
+
+
+def percentile(values,p):
+  """Returns the given percentile, [0,100], of a list of values."""
+  values = sorted(values)
+  if len(values)==0:
+    return 0.0
+  return values[min(int(len(values)*p/100.0),len(values)-1)]
+
+
+def benchmark(task):
+  # Transition, timing how long it takes in real time...
+  start = globalClock.getRealTime()
+  plugin.transition(args.config)
+  yield task.cont
+  while taskMgr.hasTaskNamed('Transition'):
+    yield task.cont
+  results['transition'] = globalClock.getRealTime() - start
+
+  # Switch to a fixed frame rate so every run simulates exactly the same thing...
+  globalClock.setMode(ClockObject.MNonRealTime)
+  globalClock.setFrameRate(args.fps)
+  ode = plugin.get('ode')
+  simStart = getattr(ode,'simTime',0.0)
+  stepStart = getattr(ode,'simSteps',0)
+
+  frames = int(args.seconds*args.fps)
+  nextEvent = 0
+  prev = globalClock.getRealTime()
+  for frame in xrange(frames):
+    # Send any input events that are due...
+    t = frame/args.fps
+    while script[nextEvent%len(script)][0] + length*(nextEvent//len(script)) <= t:
+      messenger.send(script[nextEvent%len(script)][1])
+      nextEvent += 1
+
+    yield task.cont
+    now = globalClock.getRealTime()
+    frameTimes.append(now-prev)
+    prev = now
+
+  # Collate the results, output them and exit...
+  results['frames'] = len(frameTimes)
+  results['frameMean'] = sum(frameTimes)/max(len(frameTimes),1)
+  results['frameP99'] = percentile(frameTimes,99.0)
+  results['frameMax'] = max(frameTimes+[0.0])
+  if ode!=None:
+    steps = ode.simSteps - stepStart
+    results['physicsSteps'] = steps
+    results['physicsStepMean'] = (ode.simTime - simStart)/max(steps,1)
+    results['physicsIterations'] = ode.getIterations()
+    results['physicsDropped'] = ode.getDroppedTime()
+    results['physicsAwake'], results['physicsSleeping'], results['physicsBodies'] = ode.getBodyCounts()
+  if resource!=None:
+    results['peakMemoryKB'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+  output(results)
+  plugin.end()
+
+
+taskMgr.add(benchmark,'Benchmark')
+base.run()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright Tom SF Haines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import os
+import cPickle
+import xml.etree.ElementTree as et
+
+
+# Bump whenever the compiled format changes, so old cache files get ignored...
+compiledVersion = 1
+
+
+
+class ConfigElement(et.Element):
+  """An xml element with typed attribute access - numeric attributes are parsed once, when the config is compiled, instead of every time a plugin asks for them. Otherwise identical to a normal xml.etree Element."""
+  floats = None
+
+  def typeAttributes(self):
+    """Pre-parses every attribute that is a number - called by the compiler."""
+    self.floats = dict()
+    for key,value in self.attrib.iteritems():
+      try:
+        self.floats[key] = float(value)
+      except ValueError:
+        pass
+
+  def getFloat(self,key,default = None):
+    """Returns the given attribute as a float, or default if it is not set."""
+    if self.floats!=None and self.floats.has_key(key):
+      return self.floats[key]
+    value = self.get(key)
+    if value==None:
+      return default
+    return float(value)
+
+  def getInt(self,key,default = None):
+    """Returns the given attribute as an integer, or default if it is not set."""
+    value = self.getFloat(key)
+    if value==None:
+      return default
+    return int(value)
+
+
+
+def parseConfig(filename):
+  """Parses a config file, returning the root element - all elements are ConfigElement's with their attributes pre-typed."""
+  parser = et.XMLParser(target=et.TreeBuilder(element_factory=ConfigElement))
+  root = et.parse(filename,parser).getroot()
+  for elem in root.iter():
+    elem.typeAttributes()
+  return root
+
+
+def cachePath(configDir,default = 'cache'):
+  """Returns the cache directory set by the <cache path="..."/> of the paths object in base.xml, read directly as it is needed before any config can be compiled. Returns the default if base.xml doesn't give one."""
+  try:
+    root = et.parse(configDir+'base.xml').getroot()
+  except (IOError,et.ParseError):
+    return default
+  for obj in root.findall('obj'):
+    if obj.get('name')=='paths' and obj.find('cache')!=None:
+      return obj.find('cache').get('path',default)
+  return default
+
+
+
+class ConfigCache:
+  """Compiles config files into a flat list of obj elements, with Include's expanded inline and attributes pre-typed. Compiled configs are cached, pickled, both in memory and on disk - a cached version is used whilst the modification times of every file that went into it are unchanged."""
+  def __init__(self,configDir,cacheDir):
+    self.configDir = configDir
+    self.cacheDir = cacheDir
+
+    self.memory = dict() # Config name -> (sources,pickled list of obj elements), where sources is a dictionary of filename -> modification time.
+
+  def load(self,config):
+    """Returns a list of the obj elements of the given config, with the contents of Include objects expanded inline in place of the Include objects themselves. A fresh copy is returned each time, so plugins can't mess up the cache by editing their xml."""
+    entry = self.memory.get(config,None)
+    if entry==None or not self.valid(entry[0]):
+      entry = self.loadDisk(config)
+      if entry==None or not self.valid(entry[0]):
+        entry = self.compile(config)
+        self.saveDisk(config,entry)
+      self.memory[config] = entry
+    return cPickle.loads(entry[1])
+
+
+  def compile(self,config):
+    """Internal use - compiles a config, returning (sources,pickled list of obj elements)."""
+    sources = dict()
+    objs = self.expand(config,sources)
+    return (sources,cPickle.dumps(objs,cPickle.HIGHEST_PROTOCOL))
+
+  def expand(self,config,sources):
+    """Internal use - recursivly expands a config, noting the files used in sources."""
+    filename = self.configDir+config+'.xml'
+    sources[filename] = self.mtime(filename)
+
+    ret = []
+    for obj in parseConfig(filename).findall('obj'):
+      if obj.get('type')=='Include':
+        ret += self.expand(obj.get('config'),sources)
+      else:
+        ret.append(obj)
+    return ret
+
+  def mtime(self,filename):
+    """Internal use - returns the modification time of a file, or None if it can't be obtained, such as when running from a multifile."""
+    try:
+      return os.path.getmtime(filename)
+    except OSError:
+      return None
+
+  def valid(self,sources):
+    """Internal use - returns True if none of the given source files have changed."""
+    for filename,mtime in sources.iteritems():
+      if self.mtime(filename)!=mtime:
+        return False
+    return True
+
+
+  def cacheFile(self,config):
+    return self.cacheDir+'config-'+config+'.pickle'
+
+  def loadDisk(self,config):
+    """Internal use - returns the compiled config from the disk cache, or None if it is not avaliable."""
+    try:
+      f = open(self.cacheFile(config),'rb')
+      try:
+        version, sources, objs = cPickle.load(f)
+      finally:
+        f.close()
+    except (IOError,EOFError,ValueError,cPickle.UnpicklingError):
+      return None
+
+    if version!=compiledVersion:
+      return None
+    return (sources,objs)
+
+  def saveDisk(self,config,entry):
+    """Internal use - writes a compiled config to the disk cache. Fails silently if the cache directory is not writable."""
+    try:
+      if not os.path.isdir(self.cacheDir):
+        os.makedirs(self.cacheDir)
+      f = open(self.cacheFile(config),'wb')
+      try:
+        cPickle.dump((compiledVersion,entry[0],entry[1]),f,cPickle.HIGHEST_PROTOCOL)
+      finally:
+        f.close()
+    except (IOError,OSError):
+      pass
@@ -16,37 +16,88 @@
 
 
 import sys
-import xml.etree.ElementTree as et
+import os
+import cPickle
+import hashlib
 import imp
+import posixpath
 import types
+import xml.etree.ElementTree as et
 
+from panda3d.core import TexturePool, ShaderPool
 from direct.showbase.ShowBase import ShowBase
+from direct.stdpy import threading
+
+from bin.configcache import ConfigCache, cachePath
+from bin.trace import Trace
+
+
+
+def elementHash(element):
+  """Returns a hash of an xml element and everything inside it, ignoring formatting whitespace - used to spot objects that are the same in the old and new configs of a transition."""
+  h = hashlib.md5()
+  def walk(elem):
+    h.update(repr((elem.tag,sorted(elem.attrib.items()),(elem.text or '').strip())))
+    for child in elem:
+      walk(child)
+    h.update('/')
+  walk(element)
+  return h.hexdigest()
+
 
 
 class Manager:
   """The simple plugin system - this is documented in the docs directory."""
   
-  def __init__(self,baseDir = ''):
+  def __init__(self,baseDir = '',trace = None):
     # Basic configuratrion variables...
     self.baseDir = baseDir
     self.pluginDir = 'plugins'
     self.configDir = self.baseDir+'config/'
-    self.loadingInvFrameRate = 1.0/20.0
+    self.cacheDir = self.baseDir+cachePath(self.configDir)+'/'
+    self.configCache = ConfigCache(self.configDir,self.cacheDir)
+    self.loadingInvFrameRate = 1.0/25.0 # Time budget per frame during a transition, split evenly between the objects being made - once exceeded we let Panda render a frame.
+    self.transFrame = 0 # Counts the frames rendered during transitions, so each object knows when its share of the budget renews.
+    self.maxConcurrent = 4 # Maximum number of independent objects being made at the same time during a transition.
+
+    # Timeline of where the time goes during transitions - see bin.trace. Disabled unless one is passed in...
+    if trace==None:
+      trace = Trace()
+    self.trace = trace
     
-    # The plugin database - dictionary of modules...
+    # The plugin database - dictionary of classes, indexed by type, plus the manifest of avaliable plugins - type -> (module,class,depends), where depends is a tuple of the plugin types it depends on, or None if a plugin has not declared its dependencies - and the files each type loads, type -> list of (kind,path,elem,attr,file,via) - see prefetch...
     self.plugin = dict()
+    self.manifest = dict()
+    self.manifestAssets = dict()
+    self.loadManifest()
     
     
-    # Create the instance database - a list in creation order of (obj,name) where name can be None for nameless objects, plus a dictionary to get at the objects by name...
+    # Create the instance database - a list in creation order of (obj,name,hash) where name can be None for nameless objects and hash is that of the objects xml (See elementHash.), plus a dictionary to get at the objects by name...
     self.objList = []
     self.named = dict()
 
-    # The above, but only used during transitions...
+    # The above, but only used during transitions, plus the hash of each old object indexed by id, the old nameless objects indexed by hash and the ids of the old objects that have been reused...
     self.oldObjList = None
     self.oldNamed = None
+    self.oldHash = None
+    self.oldNameless = None
+    self.reused = None
 
     # For pandaStep...
     self.lastTime = 0.0
+
+    # Learned costs, in seconds, of building and destroying each plugin type - used to estimate transition progress. Persisted between runs so the first transition of a session is estimated well too...
+    self.costFile = self.cacheDir+'plugin_costs.pickle'
+    self.defaultBuildCost = 0.05
+    self.defaultDestroyCost = 0.005
+    self.buildCost = dict()
+    self.destroyCost = dict()
+    self.loadCosts()
+
+    # Progress of the current transition - total estimated cost, estimated cost of finished work and a list of [plugin type,estimate,time spent] for the work in progress...
+    self.progTotal = 0.0
+    self.progDone = 0.0
+    self.progActive = []
   
   def transition(self,config):
     """Transitions from the current configuration to a new configuration, makes a point to keep letting Panda draw whilst it is doing so, so any special loading screen plugin can do its stuff. Maintains some variables in this class so such a plugin can also display a loading bar."""
@@ -60,35 +111,51 @@ class Manager:
     # Declare the task that is going to make the transition - done this way to keep rendering whilst we make the transition, for a loading screen etc. This is a generator for conveniance...
     def transTask(task):
       # Step 2 - move the database to 'old', make a new one...
+      self.trace.beginTransition(config)
       self.oldObjList = self.objList
       self.oldNamed = self.named
+      self.oldHash = dict()
+      self.oldNameless = dict()
+      self.reused = set()
+      for inst,name,h in self.oldObjList:
+        self.oldHash[id(inst)] = h
+        if name==None:
+          self.oldNameless.setdefault(h,[]).append(inst)
       self.objList = []
       self.named = dict()
       yield task.cont
 
-      # Step 3 - load and iterate the config file and add in each instance...
-      elem = et.parse(self.configDir+config+'.xml')
+      # Step 3 - load the config file, expanding Include's, and estimate how much work the whole transition will be...
+      objs = self.expandConfig(config)
+      self.progTotal = sum(map(lambda obj: self.estBuild(obj.get('type')),objs))
+      self.progTotal += sum(map(lambda obj: self.estDestroy(obj[0]),self.oldObjList))
+      self.progDone = 0.0
+      self.progActive = []
       yield task.cont
-      for obj in elem.findall('obj'):
-        for blah in self.addObj(obj):
-          yield task.cont
+
+      # Add in each instance - independent instances are made concurrently...
+      for blah in self.addObjs(objs):
+        yield task.cont
 
       # Step 4 - destroy the old database - call destroy methods when it exists...
       for obj in self.oldObjList:
         inst = obj[0]
-        name = obj[1]
-        if (not self.oldNamed.has_key(name)) or self.oldNamed[name]!=True:
+        if id(inst) not in self.reused:
           # It needs to die - we let the reference count being zeroed do the actual deletion but it might have a slow death, so we use the destroy method/generator to make it happen during the progress bar ratehr than blocking the gc at some random point...
-          destroy = getattr(inst,'destroy',None)
-          if isinstance(destroy,types.MethodType):
-            ret = destroy()
+          work = [inst.__class__.__name__,self.estDestroy(inst),0.0]
+          self.progActive.append(work)
+          for blah in self.costed(self.destroyObj(inst),work):
             yield task.cont
-            if isinstance(ret,types.GeneratorType):
-              for blah in ret:
-                yield task.cont
+          self.finishWork(self.destroyCost,work)
+        else:
+          self.progDone += self.estDestroy(inst)
 
       self.oldObjList = None
       self.oldNamed = None
+      self.oldHash = None
+      self.oldNameless = None
+      self.reused = None
+      self.saveCosts()
       yield task.cont
 
       # Step 5 - call start on all current objects - done in a single step to avoid problems, so no yields...
@@ -97,13 +164,18 @@ class Manager:
         if isinstance(start,types.MethodType):
           start()
 
+      self.progTotal = 0.0
+      self.trace.endTransition()
+
+    # Runs steps of the transition until the frame budget is used up, then lets Panda render a frame...
     def transFrameLimiter(task):
       prevTime = globalClock.getRealTime()
       for r in transTask(task):
         currTime = globalClock.getRealTime()
-        if (currTime-prevTime)>(1.0/25.0):
+        if (currTime-prevTime)>self.loadingInvFrameRate:
           yield task.cont
-          prevTime = currTime
+          self.transFrame += 1
+          prevTime = globalClock.getRealTime()
 
     # Create a task to do the dirty work...
     taskMgr.add(transFrameLimiter,'Transition')
@@ -135,52 +207,283 @@ class Manager:
 
   def addObj(self,element):
     """Given a xml.etree Element of type obj this does the necesary - can only be called during a transition, exposed like this for the Include class. Note that it is a generator."""
-    
+    for blah in self.addObjs([element]):
+      yield None
+
+  def addObjs(self,elements):
+    """Given a list of xml.etree Elements of type obj this makes them all, interleaving the steps of objects that do not depend on each other (See dependencies.) so their blocking loads overlap. Old objects with identical xml, whose dependencies have also been kept, are kept as they are without even a reload. They are added to the object database in the order given. Same restrictions as addObj, and also a generator."""
+    deps = self.dependencies(elements)
+    started = [False]*len(elements)
+    done = [False]*len(elements)
+    insts = [None]*len(elements)
+    kept = [False]*len(elements)
+
+    # Hash each object, including the names of the objects it depends on, so it changes if its dependencies are resolved differently...
+    hashes = []
+    for i in xrange(len(elements)):
+      depNames = sorted(map(lambda d: elements[d].get('name',elements[d].get('type')),deps[i]))
+      hashes.append(elementHash(elements[i])+repr(depNames))
+    running = [] # List of [index,generator,frame,time used in frame] for the objects currently being made.
+    remaining = len(elements)
+
+    while remaining>0:
+      # Start making any objects whose dependencies have all been made, in config order, up to the concurrency limit...
+      for i in xrange(len(elements)):
+        if len(running)>=self.maxConcurrent: break
+        if (not started[i]) and len(filter(lambda d: not done[d],deps[i]))==0:
+          started[i] = True
+          canKeep = len(filter(lambda d: not kept[d],deps[i]))==0
+          running.append([i,self.makeObj(elements[i],hashes[i],canKeep,insts,kept,i),None,0.0])
+
+      # Advance each of the running objects until it has used its share of the frame's time budget, so one slow object can't starve the rest or stall the frame...
+      share = self.loadingInvFrameRate / max(len(running),1)
+      stepped = False
+      for entry in running[:]:
+        while True:
+          if entry[2]!=self.transFrame:
+            entry[2] = self.transFrame
+            entry[3] = 0.0
+          if entry[3]>=share:
+            break
+
+          start = globalClock.getRealTime()
+          try:
+            entry[1].next()
+          except StopIteration:
+            running.remove(entry)
+            done[entry[0]] = True
+            remaining -= 1
+            break
+          finally:
+            entry[3] += globalClock.getRealTime() - start
+          stepped = True
+          yield None
+
+      # Everything has used its share - let the frame limiter see that the budget is gone...
+      if not stepped:
+        yield None
+
+    # Stick them all in the object database, in order...
+    for i in xrange(len(elements)):
+      self.objList.append((insts[i],elements[i].get('name'),hashes[i]))
+
+  def makeObj(self,element,h,canKeep,insts,kept,index):
+    """Internal use - makes a single object whilst tracking progress, leaving it in insts[index] and setting kept[index] if an old object was kept as is. Generator."""
+    work = [element.get('type'),self.estBuild(element.get('type')),0.0]
+    self.progActive.append(work)
+    for blah in self.costed(self.buildObj(element,h,canKeep,insts,kept,index),work):
+      yield None
+    if kept[index]:
+      self.finishWork(None,work) # Keeping an object costs nothing, so don't let it skew the learned cost.
+    else:
+      self.finishWork(self.buildCost,work)
+
+  def buildObj(self,element,h,canKeep,insts,kept,index):
+    """Internal use - does the actual work of making an object, either by keeping an identical old object, reusing an old object or creating a new one. Generator."""
     # Step 1 - get the details of the plugin we will be making...
     plugin = element.get('type')
     name = element.get('name')
 
+    # Step 1b - if an old object had identical xml, and nothing it depends on has changed, keep it untouched...
+    if canKeep:
+      if name!=None:
+        old = self.oldNamed.get(name,None)
+        if old is True or old is None or self.oldHash[id(old)]!=h:
+          old = None
+      else:
+        old = None
+        if len(self.oldNameless.get(h,[]))!=0:
+          old = self.oldNameless[h].pop(0)
+
+      if old!=None:
+        print 'Keeping', plugin
+        if name!=None:
+          self.oldNamed[name] = True
+          self.named[name] = old
+        self.reused.add(id(old))
+        insts[index] = old
+        kept[index] = True
+        return
+
     # Step 2 - get the plugin - load it if it is not already loaded...
     if not self.plugin.has_key(plugin):
-      print 'Loading plugin', plugin
-      base = self.pluginDir + '.' + plugin.lower()
-      plug = __import__(base, globals(), locals(),[plugin.lower()])
-      plug = getattr(plug,plugin.lower())
-      self.plugin[plugin] = plug
-      print 'Loaded', plugin
+      self.importPlugin(plugin)
       yield None
 
     # Step 3a - check if there is an old object that can be repurposed, otherwise create a new object...
-    done = False
-    if self.oldNamed.has_key(name) and isinstance(self.oldNamed[name], getattr(self.plugin[plugin],plugin)) and getattr(self.oldNamed[name],'reload',None)!=None:
+    if self.oldNamed.has_key(name) and isinstance(self.oldNamed[name], self.plugin[plugin]) and getattr(self.oldNamed[name],'reload',None)!=None:
       print 'Reusing', plugin
       inst = self.oldNamed[name]
-      self.oldNamed[name] = True # So we know its been re-used for during the deletion phase.
-      inst.reload(self,element)
+      self.oldNamed[name] = True # So it can't be re-used twice.
+      self.reused.add(id(inst)) # So we know its been re-used for during the deletion phase.
+      with self.trace.span(plugin,'reload'):
+        inst.reload(self,element)
       yield None
       print 'Reused',plugin
       if getattr(inst,'postReload',None)!=None:
-        for blah in inst.postReload():
+        for blah in self.trace.steps(inst.postReload(),plugin,'postReload'):
           yield None
         print 'post reload',plugin
     else:
       print 'Making', plugin
-      inst = getattr(self.plugin[plugin],plugin)(self,element)
+      with self.trace.span(plugin,'construct'):
+        inst = self.plugin[plugin](self,element)
       yield None
       print 'Made', plugin
       if getattr(inst,'postInit',None)!=None:
-        for blah in inst.postInit():
+        for blah in self.trace.steps(inst.postInit(),plugin,'postInit'):
           yield None
         print 'post init',plugin
 
-    # Step 3b - Stick it in the object database...
-    self.objList.append((inst,name))
+    # Step 3b - make it avaliable - named objects straight away, as other objects may be waiting on it...
+    insts[index] = inst
     if name!=None:
       self.named[name] = inst
 
     # One last yield, just to keep things going...
     yield None
 
+  def destroyObj(self,inst):
+    """Internal use - calls the destroy method of an object, if it has one, iterating it if its a generator. Generator."""
+    destroy = getattr(inst,'destroy',None)
+    if isinstance(destroy,types.MethodType):
+      plugin = inst.__class__.__name__
+      with self.trace.span(plugin,'destroy'):
+        ret = destroy()
+      yield None
+      if isinstance(ret,types.GeneratorType):
+        for blah in self.trace.steps(ret,plugin,'destroy'):
+          yield None
+
+  def costed(self,gen,work):
+    """Internal use - passes through the steps of the given generator, charging the real time from its first step to the end of its latest to the given piece of work in progress. This includes the time it spends waiting for asynchronous loads between steps, which is what the progress bar has to cover."""
+    start = globalClock.getRealTime()
+    while True:
+      try:
+        gen.next()
+      finally:
+        work[2] = globalClock.getRealTime() - start
+      yield None
+
+  def loadManifest(self):
+    """Loads the plugin manifest - an index of the plugins avaliable, so they can be imported only when actually used."""
+    elem = et.parse(self.baseDir+self.pluginDir+'/manifest.xml')
+    for plug in elem.findall('plugin'):
+      depends = plug.get('depends')
+      if depends!=None:
+        depends = tuple(filter(lambda d: d!='',map(lambda d: d.strip(),depends.split(','))))
+      self.manifest[plug.get('type')] = (plug.get('module'),plug.get('class'),depends)
+      self.manifestAssets[plug.get('type')] = map(lambda a: (a.get('kind'),a.get('path'),a.get('elem'),a.get('attr','filename'),a.get('file'),a.get('via','assets')),plug.findall('asset'))
+
+  def importPlugin(self,plugin):
+    """Imports the given plugin type and adds its class to the plugin database. Plugins missing from the manifest are assumed to follow the naming convention of plugins/<lower>/<lower>.py containing a class named after the type."""
+    print 'Loading plugin', plugin
+    if self.manifest.has_key(plugin):
+      module, cls, depends = self.manifest[plugin]
+    else:
+      module = plugin.lower() + '.' + plugin.lower()
+      cls = plugin
+
+    base = self.pluginDir + '.' + module
+    with self.trace.span(plugin,'import'):
+      plug = __import__(base, globals(), locals(),[module.split('.')[-1]])
+    self.plugin[plugin] = getattr(plug,cls)
+    print 'Loaded', plugin
+
+  def preImport(self,config):
+    """Arranges for every plugin the given config uses to be imported ahead of time, one per frame, so a later transition to it does not stall on importing heavy modules. Intended for use whilst something like a menu is showing."""
+    todo = []
+    for obj in self.expandConfig(config):
+      if obj.get('type') not in todo:
+        todo.append(obj.get('type'))
+
+    def importTask(task):
+      while len(todo)!=0:
+        plugin = todo.pop(0)
+        if not self.plugin.has_key(plugin):
+          self.importPlugin(plugin)
+          return task.cont
+      return task.done
+
+    taskMgr.add(importTask,'PreImport')
+
+  def prefetch(self,config):
+    """Starts loading the files the given config will need in the background, whilst the current config keeps running, so a later transition to it mostly consists of attaching nodes that are already loaded. Models are loaded asynchronously by Panda's loader, into the asset cache, named assets, if it exists and the plugin uses it, otherwise into Panda's model pool. Textures and shaders are read into Panda's pools by a background thread, with the textures then handed to the asset cache a frame at a time, which is cheap as they come straight from the pool. The files of each plugin type are declared by asset tags in the plugin manifest."""
+    todo = self.configAssets(config)
+    assets = self.get('assets')
+
+    def modelLoaded(model,filename,cached):
+      if model!=None:
+        model.removeNode()
+        if cached:
+          assets.release(filename) # Leaves it in the cache, unused, for the transition to pick up.
+
+    for kind, filename, via in filter(lambda a: a[0]=='model',todo):
+      cached = assets!=None and via=='assets'
+      if cached:
+        assets.loadModel(filename, callback=lambda m, f=filename: modelLoaded(m,f,True))
+      else:
+        loader.loadModel(filename, callback=lambda m, f=filename: modelLoaded(m,f,False))
+
+    # Textures and shaders are read on another thread, as Panda's loader can only do models asynchronously...
+    files = filter(lambda a: a[0]!='model',todo)
+    if len(files)==0:
+      return
+    ready = [] # Filenames of textures read into the pool, to be given to the asset cache.
+    finished = [False]
+
+    def readFiles():
+      for kind, filename, via in files:
+        if kind=='texture':
+          tex = TexturePool.loadTexture(filename)
+          if tex==None:
+            print 'Warning: Could not prefetch', filename
+          elif assets!=None and via=='assets':
+            ready.append(filename)
+        elif kind=='shader':
+          if ShaderPool.loadShader(filename)==None:
+            print 'Warning: Could not prefetch', filename
+      finished[0] = True
+
+    def handoverTask(task):
+      if len(ready)!=0:
+        filename = ready.pop(0)
+        assets.loadTexture(filename)
+        assets.release(filename)
+        return task.cont
+      if finished[0]:
+        return task.done
+      return task.cont
+
+    threading.Thread(target=readFiles,name='Prefetch').start()
+    if assets!=None:
+      taskMgr.add(handoverTask,'Prefetch')
+
+  def configAssets(self,config):
+    """Returns a list of (kind,filename,via) for the files used by the objects of the given config, as declared in the plugin manifest, without duplicates - via is assets if the plugin loads the file through the asset cache, loader if directly with Panda's loader. Paths are resolved using the paths object of the config itself."""
+    objs = self.expandConfig(config)
+    paths = dict()
+    for obj in objs:
+      if obj.get('type')=='Global' and obj.get('name')=='paths':
+        for elem in obj:
+          paths[elem.tag] = elem.get('path')
+
+    ret = []
+    for obj in objs:
+      for kind, path, elemName, attr, filename, via in self.manifestAssets.get(obj.get('type'),[]):
+        if elemName!=None:
+          elems = obj.findall(elemName)
+        else:
+          elems = [obj]
+
+        for elem in elems:
+          name = filename or elem.get(attr)
+          if name==None or not paths.has_key(path): continue
+          asset = (kind,posixpath.join(paths[path],name),via)
+          if asset not in ret:
+            ret.append(asset)
+    return ret
+
   def get(self,name):
     """Returns the plugin instance associated with the given name, or None if it doesn't exist."""
     if self.named.has_key(name):
@@ -189,5 +492,89 @@ class Manager:
       return None
 
   def getPercentage(self):
-    """During a transition this will return [0,1] indicating percentage done - for a loading plugin to use. Calling at other times will return 1.0 This is not yet implimented, as it needs to get very clever to compensate for variable loading times and includes."""
-    return 1.0
+    """During a transition this will return [0,1] indicating percentage done - for a loading plugin to use. Calling at other times will return 1.0 The estimate is weighted by the learned cost of each plugin type, with work in progress credited up to its estimate."""
+    if self.progTotal<=0.0:
+      return 1.0
+    done = self.progDone
+    for work in self.progActive:
+      done += min(work[2],work[1])
+    return min(done/self.progTotal,1.0)
+
+
+  def expandConfig(self,config):
+    """Returns a list of the obj elements of the given config, with the contents of Include objects expanded inline in place of the Include objects themselves. Comes from the compiled config cache, so its fast and the elements support typed attribute access - see bin.configcache."""
+    return self.configCache.load(config)
+
+  def dependencies(self,elements):
+    """Given a list of obj elements returns a list, aligned with it, of the sets of indices of earlier elements that must be fully made before each one can be started. These come from plugin/source attributes naming other objects and from the plugin types declared as dependencies in the plugin manifest, which match every earlier object of that type, whatever it is called. Plugins that have not declared their dependencies depend on everything before them, and everything after them depends on them, so they are made in strict order with respect to everything else."""
+    ret = []
+    byName = dict()
+    byType = dict() # Plugin type -> list of indices.
+    barrier = None # Index of the last object without declared dependencies - everything after it has to wait for it.
+    for i in xrange(len(elements)):
+      element = elements[i]
+      plugin = element.get('type')
+      declared = self.manifest.get(plugin,(None,None,None))[2]
+      if declared!=None:
+        deps = set()
+        for dep in declared:
+          deps.update(byType.get(dep,[]))
+        for elem in element.iter():
+          for key in ('plugin','source'):
+            if byName.has_key(elem.get(key)):
+              deps.add(byName[elem.get(key)])
+        if barrier!=None:
+          deps.add(barrier)
+      else:
+        deps = set(xrange(i))
+        barrier = i
+      ret.append(deps)
+
+      byType.setdefault(plugin,[]).append(i)
+      if element.get('name')!=None:
+        byName[element.get('name')] = i
+    return ret
+
+  def estBuild(self,plugin):
+    """Returns the estimated cost of making/reloading an instance of the given plugin type."""
+    return self.buildCost.get(plugin,self.defaultBuildCost)
+
+  def estDestroy(self,inst):
+    """Returns the estimated cost of destroying the given plugin instance."""
+    return self.destroyCost.get(inst.__class__.__name__,self.defaultDestroyCost)
+
+  def finishWork(self,costs,work):
+    """Internal use - ends the given piece of work in progress, crediting its estimate to the progress and updating the learned cost of its plugin type in the given cost dictionary, if one is given."""
+    self.progActive = filter(lambda w: w is not work,self.progActive)
+    plugin, est, spent = work
+    self.progDone += est
+    if costs==None:
+      return
+    if costs.has_key(plugin):
+      costs[plugin] = 0.5*(costs[plugin]+spent)
+    else:
+      costs[plugin] = spent
+
+  def loadCosts(self):
+    """Loads the learned plugin costs from previous runs, if avaliable."""
+    try:
+      f = open(self.costFile,'rb')
+      try:
+        self.buildCost, self.destroyCost = cPickle.load(f)
+      finally:
+        f.close()
+    except (IOError,EOFError,ValueError,cPickle.UnpicklingError):
+      pass
+
+  def saveCosts(self):
+    """Saves the learned plugin costs, so the next run has good estimates from the start. Fails silently if the cache directory is not writable."""
+    try:
+      if not os.path.isdir(self.cacheDir):
+        os.makedirs(self.cacheDir)
+      f = open(self.costFile,'wb')
+      try:
+        cPickle.dump((self.buildCost,self.destroyCost),f,cPickle.HIGHEST_PROTOCOL)
+      finally:
+        f.close()
+    except (IOError,OSError):
+      pass
@@ -0,0 +1,44 @@
+# Copyright Tom SF Haines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+class NoCache:
+  """Stand in for the AssetCache plugin, for configs that don't have one - same interface, but everything is loaded directly with the loader and nothing is kept."""
+  def loadModel(self,filename,callback = None):
+    if callback==None:
+      return loader.loadModel(filename)
+    loader.loadModel(filename,callback=callback)
+    return None
+
+  def loadTexture(self,filename):
+    return loader.loadTexture(filename)
+
+  def release(self,filename):
+    pass
+
+
+
+def getAssets(manager,xml):
+  """Returns the asset cache for a plugin to load its models and textures with - the object named by an <assets plugin="..."/> tag in its xml, assets if there is no such tag. If the config has no such object a NoCache is returned instead."""
+  elem = xml.find('assets')
+  if elem!=None:
+    name = elem.get('plugin','assets')
+  else:
+    name = 'assets'
+
+  ret = manager.get(name)
+  if ret==None:
+    ret = NoCache()
+  return ret
@@ -0,0 +1,39 @@
+# Copyright Tom SF Haines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+
+import direct.stdpy.file as pfile
+
+
+# Extensions the loader will try for a model filename given without one, in order...
+modelExtensions = ('','.egg','.egg.pz','.bam')
+
+
+
+def findModelFile(path):
+  """Given a model path as passed to the loader, possibly without an extension, returns the filename it refers to, or None if it can't be found."""
+  for ext in modelExtensions:
+    if pfile.isfile(path+ext):
+      return path+ext
+  return None
+
+def fileHash(filename):
+  """Returns the md5 of a file's contents, read through Panda so it works from a multifile."""
+  f = pfile.open(filename,'rb')
+  try:
+    return hashlib.md5(f.read()).hexdigest()
+  finally:
+    f.close()
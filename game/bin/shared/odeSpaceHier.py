@@ -13,9 +13,15 @@
 # limitations under the License.
 
 
+import os
+import math
+import posixpath
+
 from panda3d.core import *
 from panda3d.ode import *
 
+from bin.shared.modelfile import fileHash
+
 
 def eggToOde(np,surfaceType): # ,depth = 0
   """Given a node path, usually from an egg that has been octreed, this constructs the same structure in ode, using a space for each node with tri-meshes within. Implimented as a generator so it doesn't screw with the framerate; final yield will return the root geom, or None if there was nothing to collide with. (This geom will probably be a space, but only probably.)"""
@@ -52,3 +58,151 @@ def eggToOde(np,surfaceType): # ,depth = 0
       space.add(geom)
       space.setSurfaceType(geom,surfaceType)
     yield OdeUtil.spaceToGeom(space)
+
+
+
+def levelTriangles(np):
+  """Given a node path extracts every triangle in the geometry under it, transformed to the coordinate system of the root of its scene graph. Generator, yielding regularly; final yield returns a list of triangles, each a tuple of 3 Point3's."""
+  tris = []
+  for gnp in np.findAllMatches('**/+GeomNode'):
+    mat = gnp.getNetTransform().getMat()
+    gn = gnp.node()
+    for i in xrange(gn.getNumGeoms()):
+      geom = gn.getGeom(i)
+      reader = GeomVertexReader(geom.getVertexData(),'vertex')
+      for p in xrange(geom.getNumPrimitives()):
+        prim = geom.getPrimitive(p).decompose()
+        for t in xrange(prim.getNumPrimitives()):
+          start = prim.getPrimitiveStart(t)
+          end = prim.getPrimitiveEnd(t)
+          if end-start!=3: continue
+          tri = []
+          for v in xrange(start,end):
+            reader.setRow(prim.getVertex(v))
+            tri.append(mat.xformPoint(Point3(reader.getData3f())))
+          tris.append(tuple(tri))
+          if len(tris)%256==0:
+            yield None
+      yield None
+  yield tris
+
+
+def clusterTriangles(tris,target):
+  """Given a list of triangles splits them into spatially coherent clusters of no more than target triangles, by recursivly splitting at the median of the longest axis of their centres. Generator, yielding regularly; final yield returns a list of clusters, each a list of triangles."""
+  centres = map(lambda t: ((t[0][0]+t[1][0]+t[2][0])/3.0,(t[0][1]+t[1][1]+t[2][1])/3.0,(t[0][2]+t[1][2]+t[2][2])/3.0),tris)
+  ret = []
+  stack = [range(len(tris))]
+  while len(stack)!=0:
+    ind = stack.pop()
+    if len(ind)<=target:
+      if len(ind)!=0:
+        ret.append(map(lambda i: tris[i],ind))
+      continue
+
+    low = map(lambda d: min(map(lambda i: centres[i][d],ind)),xrange(3))
+    high = map(lambda d: max(map(lambda i: centres[i][d],ind)),xrange(3))
+    dim = max(xrange(3),key=lambda d: high[d]-low[d])
+
+    ind.sort(key=lambda i: centres[i][dim])
+    half = len(ind)//2
+    stack.append(ind[:half])
+    stack.append(ind[half:])
+    yield None
+  yield ret
+
+
+def trianglesToNodePath(tris):
+  """Given a list of triangles returns a NodePath of a GeomNode containing them."""
+  vdata = GeomVertexData('collision',GeomVertexFormat.getV3(),Geom.UHStatic)
+  writer = GeomVertexWriter(vdata,'vertex')
+  prim = GeomTriangles(Geom.UHStatic)
+  for i,tri in enumerate(tris):
+    for v in tri:
+      writer.addData3f(v)
+    prim.addConsecutiveVertices(3*i,3)
+    prim.closePrimitive()
+
+  geom = Geom(vdata)
+  geom.addPrimitive(prim)
+  node = GeomNode('collision')
+  node.addGeom(geom)
+  return NodePath(node)
+
+
+def balancedClusters(np,target = 256):
+  """Extracts all the triangles under the given node path and clusters them spatially, into clusters of no more than target triangles. Generator, yielding regularly; final yield returns a NodePath with a GeomNode child per cluster, in the coordinate system of np's scene graph root - suitable for caching as a bam file, or None if there were no triangles."""
+  for r in levelTriangles(np):
+    yield None
+    tris = r
+  if len(tris)==0:
+    yield None
+    return
+
+  for r in clusterTriangles(tris,target):
+    yield None
+    clusters = r
+
+  root = NodePath(ModelRoot('collision')) # A ModelRoot, so a bam of it loads back the same shape.
+  for cluster in clusters:
+    trianglesToNodePath(cluster).reparentTo(root)
+    yield None
+  yield root
+
+
+def clustersToOde(root,surfaceType,spaceType = 'quadtree'):
+  """Given the output of balancedClusters this makes a tri-mesh for each cluster and puts them in a single quadtree or hash space (spaceType), sized to the level. Generator, same interface as eggToOde."""
+  if root==None or root.getNumChildren()==0:
+    yield None
+    return
+
+  # Make a tri-mesh for each cluster, noting the size of each...
+  geoms = []
+  sizes = []
+  for cluster in root.getChildren():
+    cLow, cHigh = cluster.getTightBounds()
+    sizes.append(max(cHigh[0]-cLow[0],cHigh[1]-cLow[1],cHigh[2]-cLow[2]))
+    geoms.append(OdeTriMeshGeom(OdeTriMeshData(cluster,True)))
+    yield None
+
+  # Create the space, sized to the level and the clusters...
+  if spaceType=='hash':
+    space = OdeHashSpace()
+    minLevel = int(math.floor(math.log(max(min(sizes),1e-3),2.0)))
+    maxLevel = int(math.ceil(math.log(max(max(sizes),1e-3),2.0)))
+    space.setLevels(minLevel,max(maxLevel,minLevel))
+  else:
+    # Enough depth that the leaves are about the size of a cluster...
+    low, high = root.getTightBounds()
+    extent = high-low
+    depth = int(math.ceil(math.log(len(geoms),4.0)))+1
+    space = OdeQuadTreeSpace(low+extent*0.5,extent,min(max(depth,1),8))
+
+  for geom in geoms:
+    space.add(geom)
+    space.setSurfaceType(geom,surfaceType)
+  yield OdeUtil.spaceToGeom(space)
+
+
+def eggToOdeBalanced(np,surfaceType,target = 256,spaceType = 'quadtree'):
+  """An alternative to eggToOde that ignores the structure of the egg - all the triangles are extracted and clustered spatially into tri-meshes of around target triangles each, which are put in a single quadtree or hash space (spaceType) sized to the level. This gives the broadphase a balanced structure to work with, whatever the artist exported. Generator, same interface as eggToOde. Use balancedClusters and clustersToOde directly to cache the clusters."""
+  for r in balancedClusters(np,target):
+    yield None
+    root = r
+  for r in clustersToOde(root,surfaceType,spaceType):
+    yield None
+    geom = r
+  yield geom
+
+
+def clusterCacheFile(cacheDir,eggFile,target):
+  """Returns the filename to cache the output of balancedClusters in, for the given collision egg file - keyed by the hash of the file and the target triangle count."""
+  return posixpath.join(cacheDir,'collision-%s-%i.bam'%(fileHash(eggFile),target))
+
+def saveClusters(root,filename):
+  """Writes the output of balancedClusters to a bam file, creating the directory if needed. Returns True on success - failure is not fatal, as its just a cache."""
+  try:
+    if not os.path.isdir(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+  except OSError:
+    return False
+  return root.writeBamFile(filename)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright Tom SF Haines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import time
+import json
+
+
+# Thread ids used to lay out the timeline - the main thread, the async model loads and the transitions as a whole...
+tidMain = 1
+tidAsync = 2
+tidTransition = 3
+
+# Categories of span that count towards a plugins cost in the summary table...
+summaryCats = ('import','construct','reload','postInit','postReload','destroy')
+
+
+
+class Span:
+  """Context manager returned by Trace.span - records a span covering the with block."""
+  def __init__(self,trace,name,cat,args):
+    self.trace = trace
+    self.name = name
+    self.cat = cat
+    self.args = args
+
+  def __enter__(self):
+    self.start = self.trace.now()
+
+  def __exit__(self,excType,excValue,tb):
+    self.trace.record(self.name,self.cat,self.start,self.trace.now(),args=self.args)
+    return False
+
+
+
+class Trace:
+  """Records a timeline of timestamped spans - plugin imports, constructors, postInit/postReload/destroy steps, model and texture loads - which is written out in the Chrome trace format, so it can be viewed with chrome://tracing. Also keeps a summary of where the time went for each config. If constructed without a filename it is disabled, and does nothing, cheaply."""
+  def __init__(self,filename = None):
+    self.filename = filename
+    self.enabled = filename!=None
+    self.origin = time.time()
+
+    self.events = []
+    self.config = None # Config currently being transitioned to.
+    self.costs = dict() # Config -> plugin type -> seconds.
+
+  def now(self):
+    """Returns the current time, as used for the timeline."""
+    return time.time()
+
+  def record(self,name,cat,start,end,tid = tidMain,args = None):
+    """Records a span, given its start and end times as returned by now()."""
+    if not self.enabled: return
+    event = {'name':name, 'cat':cat, 'ph':'X', 'pid':1, 'tid':tid, 'ts':1e6*(start-self.origin), 'dur':1e6*(end-start)}
+    if args!=None:
+      event['args'] = args
+    self.events.append(event)
+
+    if self.config!=None and cat in summaryCats:
+      costs = self.costs.setdefault(self.config,dict())
+      costs[name] = costs.get(name,0.0) + end - start
+
+  def span(self,name,cat,args = None):
+    """Returns a context manager that records a span covering a with block."""
+    return Span(self,name,cat,args)
+
+  def steps(self,gen,name,cat):
+    """Passes through the steps of the given generator, recording each step as a span."""
+    if not self.enabled:
+      for blah in gen:
+        yield blah
+      return
+
+    while True:
+      start = self.now()
+      try:
+        ret = gen.next()
+      finally:
+        self.record(name,cat,start,self.now())
+      yield ret
+
+
+  def hookLoader(self,loader):
+    """Wraps the model, texture and shader loading methods of the given loader so every load is recorded. Asynchronous model loads are recorded from request to arrival on their own row of the timeline."""
+    if not self.enabled: return
+
+    def wrap(method,cat):
+      def traced(filename,*args,**kwargs):
+        callback = kwargs.get('callback',None)
+        if callback!=None:
+          start = self.now()
+          def tracedCallback(*cbArgs):
+            self.record(str(filename),cat,start,self.now(),tidAsync)
+            return callback(*cbArgs)
+          kwargs['callback'] = tracedCallback
+          return method(filename,*args,**kwargs)
+        else:
+          with self.span(str(filename),cat):
+            return method(filename,*args,**kwargs)
+      return traced
+
+    loader.loadModel = wrap(loader.loadModel,'loadModel')
+    loader.loadTexture = wrap(loader.loadTexture,'loadTexture')
+    loader.loadShader = wrap(loader.loadShader,'loadShader')
+
+
+  def beginTransition(self,config):
+    """Marks the start of a transition, so spans are summarised against the config."""
+    self.config = config
+    self.transStart = self.now()
+
+  def endTransition(self):
+    """Marks the end of a transition - prints the summary table for the config and writes out everything recorded so far."""
+    if not self.enabled: return
+    self.record(self.config,'transition',self.transStart,self.now(),tidTransition)
+    print self.summary(self.config)
+    self.config = None
+    self.write()
+
+  def summary(self,config,count = 10):
+    """Returns, as a string, a table of the slowest plugin types for the given config."""
+    costs = sorted(self.costs.get(config,dict()).items(),key=lambda x: -x[1])
+    lines = ['Slowest plugins for %s:'%config]
+    for plugin,cost in costs[:count]:
+      lines.append('  %-24s %8.1f ms'%(plugin,1e3*cost))
+    return '\n'.join(lines)
+
+  def write(self):
+    """Writes the timeline, plus the summary tables, to disk."""
+    f = open(self.filename,'w')
+    try:
+      json.dump({'traceEvents':self.events, 'summary':self.costs},f)
+    finally:
+      f.close()
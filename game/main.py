@@ -22,15 +22,28 @@
 from panda3d.core import loadPrcFile, loadPrcFileData
 loadPrcFile("config/settings.prc")
 loadPrcFileData("window-disable", "window-type none")
-from direct.showbase.ShowBase import ShowBase
-import direct.stdpy.file as pfile
-from direct.task import Task
-
-from bin.manager import *
+from panda3d.core import ConfigVariableBool, ConfigVariableString
 
 import sys
 
-base = ShowBase()
+# Switch on tracing if requested, before anything heavy happens so it gets recorded...
+from bin.trace import Trace
+args = filter(lambda a: a!='--trace',sys.argv[1:])
+if len(args)!=len(sys.argv)-1 or ConfigVariableBool('naith-trace',False).getValue():
+  trace = Trace(ConfigVariableString('naith-trace-file','trace.json').getValue())
+else:
+  trace = Trace()
+
+with trace.span('import','startup'):
+  from direct.showbase.ShowBase import ShowBase
+  import direct.stdpy.file as pfile
+  from direct.task import Task
+
+  from bin.manager import *
+
+with trace.span('ShowBase','startup'):
+  base = ShowBase()
+trace.hookLoader(base.loader)
 #messenger.toggleVerbose()
 
 # Detect if we are in a multifile and, if so, jump through hoops that shouldn't exist...
@@ -41,12 +54,13 @@ else:
   baseDir = ''
 
 # Create the manager - this does it all...
-plugin = Manager(baseDir)
+with trace.span('Manager','startup'):
+  plugin = Manager(baseDir,trace)
 
 # Create a task to do the work of getting the game going...
 def firstLight(task):
-  if len(sys.argv)>1:
-    cn = sys.argv[1]
+  if len(args)>0:
+    cn = args[0]
   else:
     cn = 'menu'
   
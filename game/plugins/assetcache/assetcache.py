@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# Copyright Tom SF Haines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+
+from panda3d.core import *
+
+
+class AssetCache:
+  """Central cache of models and textures, shared by the other plugins - goes in the base config, named assets, so it survives transitions. Assets are reference counted, every load being matched by a release, but when nothing is using an asset it is kept anyway until the cache exceeds its memory budget, given as <budget mb="256"/>, at which point the least recently used are freed. This way going back and forth between configs reuses what is already resident. Models are handed out as copies that share the cached geometry, so users can modify and remove them as they please; textures are shared directly."""
+  def __init__(self,manager,xml):
+    self.assets = collections.OrderedDict() # filename -> [model NodePath or Texture,reference count,size in bytes], in least recently used order.
+    self.pending = dict() # filename -> list of callbacks, for models being loaded asynchronously.
+    self.size = 0
+
+    self.reload(manager,xml)
+
+  def reload(self,manager,xml):
+    budget = xml.find('budget')
+    if budget!=None:
+      self.budget = int(budget.getFloat('mb',256.0)*1024*1024)
+    else:
+      self.budget = 256*1024*1024
+    self.evict()
+
+  def destroy(self):
+    for asset,refs,size in self.assets.itervalues():
+      self.free(asset)
+    self.assets.clear()
+    self.size = 0
+
+
+  def loadModel(self,filename,callback = None):
+    """Returns a copy of the given model, loading it if it is not in the cache - same interface as loader.loadModel, so if a callback is given it is loaded asynchronously and handed to the callback instead. Must be matched by a call to release with the same filename."""
+    entry = self.assets.get(filename)
+    if entry!=None:
+      self.use(filename,entry)
+      model = NodePath(entry[0].node().copySubgraph())
+      if callback==None:
+        return model
+      callback(model)
+      return None
+
+    if callback==None:
+      entry = self.add(filename,loader.loadModel(filename,noCache=True))
+      return NodePath(entry[0].node().copySubgraph())
+
+    # Asynchronous - only request it once, however many want it...
+    if self.pending.has_key(filename):
+      self.pending[filename].append(callback)
+      return None
+    self.pending[filename] = [callback]
+
+    def loaded(model):
+      callbacks = self.pending.pop(filename,[])
+      if model==None:
+        for cb in callbacks:
+          cb(None)
+        return
+      if self.assets.has_key(filename) or len(callbacks)==0: # Loaded synchronously in the meantime, or nobody wants it anymore.
+        model.removeNode()
+        for cb in callbacks:
+          self.loadModel(filename,cb)
+      else:
+        entry = self.add(filename,model,len(callbacks))
+        for cb in callbacks:
+          cb(NodePath(entry[0].node().copySubgraph()))
+
+    loader.loadModel(filename,noCache=True,callback=loaded)
+    return None
+
+  def loadTexture(self,filename):
+    """Returns the given texture, loading it if it is not in the cache. Must be matched by a call to release with the same filename."""
+    entry = self.assets.get(filename)
+    if entry==None:
+      entry = self.add(filename,loader.loadTexture(filename))
+    else:
+      self.use(filename,entry)
+    return entry[0]
+
+  def release(self,filename):
+    """Indicates that something is done with an asset obtained from loadModel or loadTexture. When nothing is using it the asset stays in the cache, to be freed only when the budget is exceeded. Releasing models does not remove the copy that was handed out - that remains the responsibility of the user."""
+    entry = self.assets.get(filename)
+    if entry!=None:
+      entry[1] = max(entry[1]-1,0)
+      if entry[1]==0:
+        self.touch(filename,entry)
+        self.evict()
+
+
+  def getSize(self):
+    """Returns the estimated memory used by the cache, in bytes."""
+    return self.size
+
+  def getBudget(self):
+    """Returns the memory budget, in bytes."""
+    return self.budget
+
+
+  def add(self,filename,asset,refs = 1):
+    """Internal use - adds a freshly loaded asset to the cache with the given number of references, for whoever asked for it, and returns its entry. The references are taken before making room for it, so it can't be evicted straight away."""
+    if isinstance(asset,NodePath):
+      size = modelSize(asset)
+    else:
+      size = asset.estimateTextureMemory()
+    entry = [asset,refs,size]
+    self.assets[filename] = entry
+    self.size += size
+    self.evict()
+    return entry
+
+  def use(self,filename,entry):
+    """Internal use - adds a reference to an entry."""
+    entry[1] += 1
+    self.touch(filename,entry)
+
+  def touch(self,filename,entry):
+    """Internal use - makes an entry the most recently used."""
+    del self.assets[filename]
+    self.assets[filename] = entry
+
+  def evict(self):
+    """Internal use - frees unused assets, least recently used first, until the cache is within budget."""
+    if self.size<=self.budget:
+      return
+    for filename,entry in self.assets.items():
+      if entry[1]==0:
+        del self.assets[filename]
+        self.free(entry[0])
+        self.size -= entry[2]
+        if self.size<=self.budget:
+          break
+
+  def free(self,asset):
+    """Internal use - actually frees an asset."""
+    if isinstance(asset,NodePath):
+      asset.removeNode()
+    else:
+      TexturePool.releaseTexture(asset)
+
+
+
+def modelSize(model):
+  """Returns an estimate of the memory used by a model, in bytes - its vertex and index arrays plus its textures."""
+  ret = 0
+  for np in model.findAllMatches('**/+GeomNode'):
+    node = np.node()
+    for i in xrange(node.getNumGeoms()):
+      geom = node.getGeom(i)
+      vdata = geom.getVertexData()
+      for a in xrange(vdata.getNumArrays()):
+        ret += vdata.getArray(a).getDataSizeBytes()
+      for p in xrange(geom.getNumPrimitives()):
+        vertices = geom.getPrimitive(p).getVertices()
+        if vertices!=None:
+          ret += vertices.getDataSizeBytes()
+
+  for tex in model.findAllTextures():
+    ret += tex.estimateTextureMemory()
+  return ret
@@ -13,10 +13,16 @@
 # limitations under the License.
 
 
+import bisect
 import math
 
 from panda3d.core import *
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 
 class AABB:
   """Defines an axis aligned bounding box."""
@@ -31,7 +37,10 @@ class AABB:
 
   def within(self,node):
     """Given a NodePath returns True if its in the AABB, False if it isn't."""
-    pos = node.getPos(render)
+    return self.contains(node.getPos(render))
+
+  def contains(self,pos):
+    """Given a position, as anything indexable, returns True if its in the AABB, False if it isn't."""
     return pos[0]>=self.x[0] and pos[0]<=self.x[1] and pos[1]>=self.y[0] and pos[1]<=self.y[1] and pos[2]>=self.z[0] and pos[2]<=self.z[1]
 
   def __str__(self):
@@ -39,108 +48,257 @@ class AABB:
 
 
 
-aabbLambda = 1e-3
-aabbCutCost = 2.0
+# Parameters of the kd tree builder - maximum aabbs in a leaf, number of split positions tried per dimension, maximum depth and the cost of a node relative to testing an aabb...
+kdLeafSize = 4
+kdBins = 16
+kdMaxDepth = 32
+kdTraverseCost = 1.0
 
 
 class SetAABB:
-  """A set of AABB's - uses a kd tree with hieuristic dimension detection to subdivide at each point. Each level keeps a list of aabb's that cross the dividing line."""
-  def __init__(self,aabbs):
-    """Given a list of AABB's."""
-    # Work out what happens for dividing on each dimension - sort by the AABB's centres and then select the centre aabb by volume, then try dividing by the sides & centre of the centre aabb and count how many nodes are intercepted with a cost for offsetting too far - select the dimension division with the least divided nodes...
-    # Get half the volume...
-    totVolume = sum(map(lambda x:x.volume,aabbs))
-    halfVolume = totVolume*0.5
-
-    # Variables we are finding the best option for...
-    bestDimension = 0
-    bestCutPoint = 0.0
-    bestCost = 1e20
-    bestLow = []
-    bestMid = aabbs
-    bestHigh = []
-    
-    # Try each dimension, with multiple centre choice, store the best...
+  """A set of AABB's - uses a kd tree where each node splits a dimension, chosen to minimise the expected cost of a point query. Each level keeps a subtree of the aabb's that cross the dividing line. The tree is stored flat, as arrays indexed by node, so it can be queried for many points at once - with numpy, if avaliable, the batch queries are vectorised."""
+  def __init__(self,aabbs,state = None):
+    """Given a list of AABB's. Optionally given the state of a previously built tree for the same list, as returned by getState, to avoid building it again."""
+    self.aabbs = aabbs
+
+    # The bounds of each aabb, flattened - low x,y,z then high x,y,z...
+    self.boxes = map(lambda a: (a.x[0],a.y[0],a.z[0],a.x[1],a.y[1],a.z[1]),aabbs)
+
+    # The tree - for each node the split dimension, -1 for a leaf, the split position and the indices of the low, mid and high children, -1 when missing. Leafs instead use low and high as the range of their aabb indices in leafItems...
+    self.nodeDim = []
+    self.nodeSplit = []
+    self.nodeLow = []
+    self.nodeMid = []
+    self.nodeHigh = []
+    self.leafItems = []
+
+    # Build it, from the aabbs presorted by their bounds in each dimension...
+    self.side = [0]*len(aabbs) # Scratch space for the builder.
+    if state!=None:
+      self.nodeDim, self.nodeSplit, self.nodeLow, self.nodeMid, self.nodeHigh, self.leafItems = map(list,state)
+    elif len(aabbs)!=0:
+      byLow = map(lambda d: sorted(xrange(len(aabbs)),key=lambda i: self.boxes[i][d]),xrange(3))
+      byHigh = map(lambda d: sorted(xrange(len(aabbs)),key=lambda i: self.boxes[i][d+3]),xrange(3))
+      region = map(lambda d: min(map(lambda b: b[d],self.boxes)),xrange(3)) + map(lambda d: max(map(lambda b: b[d+3],self.boxes)),xrange(3))
+      self.build(byLow,byHigh,region,0)
+    else:
+      self.addLeaf([])
+    self.side = None
+
+    # Numpy versions, for batch queries...
+    if numpy!=None:
+      self.npBoxes = numpy.array(self.boxes,dtype=numpy.float64).reshape((-1,6))
+      self.npDim = numpy.array(self.nodeDim,dtype=numpy.int32)
+      self.npSplit = numpy.array(self.nodeSplit,dtype=numpy.float64)
+      self.npLow = numpy.array(self.nodeLow,dtype=numpy.int32)
+      self.npMid = numpy.array(self.nodeMid,dtype=numpy.int32)
+      self.npHigh = numpy.array(self.nodeHigh,dtype=numpy.int32)
+      self.npItems = numpy.array(self.leafItems,dtype=numpy.int32)
+
+
+  def getState(self):
+    """Returns the built tree as a tuple of lists, suitable for pickling and passing back into the constructor."""
+    return (self.nodeDim,self.nodeSplit,self.nodeLow,self.nodeMid,self.nodeHigh,self.leafItems)
+
+  def addNode(self,dim,split,low,mid,high):
+    """Internal use - adds a node to the flat tree, returning its index."""
+    self.nodeDim.append(dim)
+    self.nodeSplit.append(split)
+    self.nodeLow.append(low)
+    self.nodeMid.append(mid)
+    self.nodeHigh.append(high)
+    return len(self.nodeDim)-1
+
+  def addLeaf(self,indices):
+    """Internal use - adds a leaf containing the given aabb indices, returning its index."""
+    start = len(self.leafItems)
+    self.leafItems += indices
+    return self.addNode(-1,0.0,start,-1,len(self.leafItems))
+
+  def build(self,byLow,byHigh,region,depth):
+    """Internal use - recursivly builds the tree for a set of aabbs, given as their indices sorted by low bound and by high bound, for each dimension, plus the region of space the node covers. Returns the index of the new node. Splits are chosen to minimise the expected number of aabbs a point query tests, assuming query points are uniform over the region - candidate split points are spaced evenly along each dimension, and the aabbs on each side are counted by bisecting the presorted bounds."""
+    count = len(byLow[0])
+    if count<=kdLeafSize or depth>=kdMaxDepth:
+      return self.addLeaf(byLow[0])
+
+    # Find the best split - a node that is not split costs count...
+    boxes = self.boxes
+    bestCost = float(count)
+    best = None
     for dim in xrange(3):
-      byDim = sorted(aabbs,key=lambda x: x.centre[dim])
-      centre = 0
-      volume = 0.0
-      while centre+1<len(byDim) and volume<halfVolume:
-        volume += byDim[centre].volume
-        centre += 1
-
-      options = (byDim[centre].bounds[dim][0]-aabbLambda, byDim[centre].centre[dim], byDim[centre].bounds[dim][1]+aabbLambda)
-      for cutPoint in options:
-        cost = 0.0
-        lowVol = 0.0
-        highVol = 0.0
-      
-        low = []
-        mid = []
-        high = []
-      
-        for aabb in byDim:
-          if aabb.bounds[dim][1]<cutPoint:
-            lowVol += aabb.volume
-            low.append(aabb)
-          elif aabb.bounds[dim][0]>cutPoint:
-            highVol += aabb.volume
-            high.append(aabb)
-          else:
-            cost += aabb.volume*aabbCutCost
-            mid.append(aabb)
-          cost += math.fabs(lowVol-highVol)
-      
+      lo = region[dim]
+      hi = region[dim+3]
+      if hi<=lo: continue
+      lows = map(lambda i: boxes[i][dim],byLow[dim])
+      highs = map(lambda i: boxes[i][dim+3],byHigh[dim])
+
+      for b in xrange(1,kdBins):
+        split = lo + (hi-lo)*b/float(kdBins)
+        lowCount = bisect.bisect_left(highs,split) # Entirely below the split.
+        highCount = count - bisect.bisect_right(lows,split) # Entirely above the split.
+        midCount = count - lowCount - highCount # Crossing the split - always tested.
+        if midCount==count: continue
+
+        t = (split-lo)/(hi-lo)
+        cost = kdTraverseCost + midCount + t*lowCount + (1.0-t)*highCount
         if cost<bestCost:
-          bestDimension = dim
-          bestCutPoint = cutPoint
           bestCost = cost
-          bestLow = low
-          bestMid = mid
-          bestHigh = high
-
-    # We have our bests - we now make this actual object, and then recurse to make the full tree...
-    zeroCount = 0
-    if len(bestLow)==0: zeroCount += 1
-    if len(bestHigh)==0: zeroCount += 1
-    
-    if zeroCount!=2:
-      self.leaf = True
-      self.data = bestLow + bestMid + bestHigh
+          best = (dim,split)
+
+    if best==None:
+      return self.addLeaf(byLow[0])
+    dim, split = best
+
+    # Partition, keeping the sorted orders...
+    side = self.side
+    for i in byLow[0]:
+      if boxes[i][dim+3]<split:
+        side[i] = 0
+      elif boxes[i][dim]>split:
+        side[i] = 2
+      else:
+        side[i] = 1
+
+    parts = []
+    for k in xrange(3):
+      partLow = map(lambda d: filter(lambda i: side[i]==k,byLow[d]),xrange(3))
+      partHigh = map(lambda d: filter(lambda i: side[i]==k,byHigh[d]),xrange(3))
+      parts.append((partLow,partHigh))
+
+    # Recurse - the mid child covers the same region, but will split on another plane...
+    lowRegion = list(region)
+    lowRegion[dim+3] = split
+    highRegion = list(region)
+    highRegion[dim] = split
+
+    low = self.build(parts[0][0],parts[0][1],lowRegion,depth+1)
+    if len(parts[1][0][0])!=0:
+      mid = self.build(parts[1][0],parts[1][1],region,depth+1)
     else:
-      self.leaf = False
-      self.splitDim = bestDimension
-      self.split = bestCutPoint
-
-      self.low = SetAABB(bestLow)
-
-      if len(bestMid)!=0:
-        self.mid = SetAABB(bestMid)
+      mid = -1
+    high = self.build(parts[2][0],parts[2][1],highRegion,depth+1)
+    return self.addNode(dim,split,low,mid,high)
+
+  def stats(self):
+    """Returns a dictionary of statistics on the quality of the tree - node, leaf and empty leaf counts, the maximum depth, and the mean and maximum number of aabbs in a leaf."""
+    ret = {'nodes':len(self.nodeDim), 'leafs':0, 'emptyLeafs':0, 'depth':0, 'meanLeaf':0.0, 'maxLeaf':0}
+    total = 0
+    stack = [(self.root(),1)]
+    while len(stack)!=0:
+      n, depth = stack.pop()
+      ret['depth'] = max(ret['depth'],depth)
+      if self.nodeDim[n]<0:
+        size = self.nodeHigh[n] - self.nodeLow[n]
+        ret['leafs'] += 1
+        if size==0: ret['emptyLeafs'] += 1
+        ret['maxLeaf'] = max(ret['maxLeaf'],size)
+        total += size
       else:
-        self.mid = None
+        stack.append((self.nodeLow[n],depth+1))
+        stack.append((self.nodeHigh[n],depth+1))
+        if self.nodeMid[n]>=0:
+          stack.append((self.nodeMid[n],depth+1))
 
-      self.high = SetAABB(bestHigh)
+    nonEmpty = ret['leafs'] - ret['emptyLeafs']
+    if nonEmpty!=0:
+      ret['meanLeaf'] = total/float(nonEmpty)
+    return ret
 
 
   def within(self,node):
     """Returns an AABB that contains the given node, or None is none do."""
-    if self.leaf:
-      for aabb in self.data:
-        if aabb.within(node):
-          return aabb
-      return None
-    else:
-      if self.mid:
-        res = self.mid.within(node)
-        if res!=None: return res
-      
-      if node.getPos(render)[self.splitDim]<self.split:
-        res = self.low.within(node)
-        if res!=None: return res
+    return self.locate(node.getPos(render))
+
+  def locate(self,pos):
+    """Returns an AABB that contains the given position, or None if none do."""
+    i = self.locateIndex(self.root(),pos)
+    if i<0: return None
+    return self.aabbs[i]
+
+  def root(self):
+    """Internal use - index of the root node, which is always the last added."""
+    return len(self.nodeDim)-1
+
+  def locateIndex(self,n,pos):
+    """Internal use - returns the index of an aabb under node n that contains pos, or -1 if there is none."""
+    while True:
+      dim = self.nodeDim[n]
+      if dim<0:
+        for i in self.leafItems[self.nodeLow[n]:self.nodeHigh[n]]:
+          b = self.boxes[i]
+          if pos[0]>=b[0] and pos[0]<=b[3] and pos[1]>=b[1] and pos[1]<=b[4] and pos[2]>=b[2] and pos[2]<=b[5]:
+            return i
+        return -1
+
+      if self.nodeMid[n]>=0:
+        res = self.locateIndex(self.nodeMid[n],pos)
+        if res>=0: return res
+
+      if pos[dim]<self.nodeSplit[n]:
+        n = self.nodeLow[n]
       else:
-        res = self.high.within(node)
-        if res!=None: return res
-      return None
+        n = self.nodeHigh[n]
+
+  def withinMany(self,nodes):
+    """Batch version of within - given a list of NodePaths returns a list, aligned with it, of the AABB that contains each, or None."""
+    return self.locateMany(map(lambda n: n.getPos(render),nodes))
+
+  def locateMany(self,points):
+    """Batch version of locate - given a list of positions, anything indexable of length 3, returns a list, aligned with it, of the AABB that contains each, or None."""
+    if numpy==None or len(points)==0:
+      return map(self.locate,points)
+
+    pts = numpy.array(map(lambda p: (p[0],p[1],p[2]),points),dtype=numpy.float64)
+    return map(lambda i: self.aabbs[i] if i>=0 else None,self.locateIndicesNumpy(pts))
+
+  def locateIndicesNumpy(self,pts):
+    """Internal use - given a numpy array of points, one per row, returns an array of the index of the aabb containing each, -1 for none. Walks the tree for all points at once, as a frontier of (point,node) pairs that is advanced a level per iteration."""
+    res = numpy.empty(pts.shape[0],dtype=numpy.int32)
+    res.fill(-1)
+
+    fPoint = numpy.arange(pts.shape[0],dtype=numpy.int32)
+    fNode = numpy.empty(pts.shape[0],dtype=numpy.int32)
+    fNode.fill(self.root())
+
+    while fPoint.shape[0]!=0:
+      # Drop pairs whose point has already been found...
+      keep = res[fPoint]<0
+      fPoint = fPoint[keep]
+      fNode = fNode[keep]
+
+      dim = self.npDim[fNode]
+      leaf = dim<0
+
+      # Leafs - expand each pair to one pair per aabb in the leaf and test them all...
+      lPoint = fPoint[leaf]
+      lNode = fNode[leaf]
+      counts = self.npHigh[lNode] - self.npLow[lNode]
+      total = counts.sum()
+      if total!=0:
+        offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts)-counts,counts)
+        tPoint = numpy.repeat(lPoint,counts)
+        tBox = self.npItems[numpy.repeat(self.npLow[lNode],counts) + offsets]
+
+        p = pts[tPoint]
+        b = self.npBoxes[tBox]
+        hit = numpy.all((p>=b[:,:3]) & (p<=b[:,3:]),axis=1)
+        hPoint = tPoint[hit]
+        hBox = tBox[hit]
+        first = numpy.unique(hPoint,return_index=True)[1] # So each point gets the first aabb it hit.
+        res[hPoint[first]] = hBox[first]
+
+      # Internal nodes - every pair goes to the mid child, if any, and whichever of the low and high children its point is on the side of...
+      iPoint = fPoint[~leaf]
+      iNode = fNode[~leaf]
+      iDim = dim[~leaf]
+      side = numpy.where(pts[iPoint,iDim]<self.npSplit[iNode],self.npLow[iNode],self.npHigh[iNode])
+      mid = self.npMid[iNode]
+      hasMid = mid>=0
+
+      fPoint = numpy.concatenate((iPoint[hasMid],iPoint))
+      fNode = numpy.concatenate((mid[hasMid],side))
+
+    return res
 
 
 
@@ -150,6 +308,8 @@ class Portal:
     self.verts = [(1.0,0.0,1.0),(-1.0,0.0,1.0),(-1.0,0.0,-1.0),(1.0,0.0,-1.0)]
     self.aabb1 = None
     self.aabb2 = None
+    self.dim = 0 # Dimension of the face the portal is on, and the side of aabb1 it is on - 0 for low, 1 for high.
+    self.side = 0
 
   def fromFace(self,aabb,dim,side):
     """Setup the portal from a face of the given aabb - you specify the dim of the face, with side==False meaning the low side and side==True meaning the high side. Will be anti-clockwise looking at it from inside the cube."""
@@ -197,7 +357,7 @@ class Portal:
 
 
 def findPortals(aabbs,overlap = 1e-3):
-  """Given a list of AABB's this finds all intersections and creates portals. To store the portals creates a variable in each aabb, portals = [[[],[]],[[],[]],[[],[]]] - first index is dimension, second index is low (0) and high (1), final list is all portals using that face. Returns the portals as a list. Will throw an error if the geometry is bad. Will modify the dimensions of the given aabb's to account for overlap."""
+  """Given a list of AABB's this finds all intersections and creates portals, with a sweep and prune. To store the portals creates a variable in each aabb, portals = [[[],[]],[[],[]],[[],[]]] - first index is dimension, second index is low (0) and high (1), final list is all portals using that face. Returns the portals as a list. Will throw an error if the geometry is bad. Will modify the dimensions of the given aabb's to account for overlap."""
   # Before we start add the portal variable to each aabb...
   for aabb in aabbs:
     aabb.portals = [[[],[]],[[],[]],[[],[]]]
@@ -217,26 +377,52 @@ def findPortals(aabbs,overlap = 1e-3):
     # Sort the events...
     events.sort(key=lambda x: x[1])
 
+    # The active aabbs are binned by the power of two of their extent on the first of the other dimensions, and each bin is kept sorted by low bound, so only those that could overlap an event aabb on it need to be tested - they are found with a pair of bisections per bin, using the largest extent in the bin rather than of all the aabbs, so a few big aabbs don't stop the pruning for the rest...
+    od1, od2 = otherDim
+    bins = dict() # Exponent of extent -> [sorted low bounds on od1,aligned list of aabbs,largest extent]
+    binOf = dict() # id(aabb) -> its bin
+    for aabb in aabbs:
+      extent = aabb.bounds[od1][1] - aabb.bounds[od1][0]
+      entry = bins.setdefault(math.frexp(extent)[1],[[],[],0.0])
+      entry[2] = max(entry[2],extent)
+      binOf[id(aabb)] = entry
+    active = bins.values()
+
     # Iterate through the events in sequence - each time a aabb is pushed or popped check if it intercepts a face larger than it - if so add the relevant portal... (Partial interception is considered an error as it results in ambiguous behaviour. Multiple interception is also not allowed as its an entire face that intercepts from our point of view. (Larger face can have multiple intercepts of course.))
-    state = dict() # Index by id of aabb's
     for event in events:
+      box = event[2]
       if not event[0]:
-        # Pop event - remove its aabb from the state...
-        del state[id(event[2])]
-        
-      # Check event aabb against existing aabbs for being the smaller face...
+        # Pop event - remove its aabb from the active list...
+        activeKeys, activeBoxes, extent = binOf[id(box)]
+        i = bisect.bisect_left(activeKeys,box.bounds[od1][0])
+        while activeBoxes[i] is not box:
+          i += 1
+        del activeKeys[i]
+        del activeBoxes[i]
+
+      # Gather the active aabbs that could overlap the event aabb on the first of the other dimensions...
+      candidates = []
+      for activeKeys, activeBoxes, extent in active:
+        start = bisect.bisect_right(activeKeys,box.bounds[od1][0]-extent)
+        end = bisect.bisect_left(activeKeys,box.bounds[od1][1])
+        candidates += activeBoxes[start:end]
+
+      # Check event aabb against the active aabbs that overlap it in both other dimensions for being the smaller face - any other pair can't intercept...
       done = False
-      for key,aabb in state.iteritems():
+      for aabb in candidates:
+        if aabb.bounds[od1][1]<=box.bounds[od1][0] or aabb.bounds[od2][1]<=box.bounds[od2][0] or aabb.bounds[od2][0]>=box.bounds[od2][1]:
+          continue
+
         # Verify that the sorting dimension is not contained, i.e. they overlap so a portal can be created...
-        if (event[2].bounds[dim][0]>aabb.bounds[dim][0]) == (event[2].bounds[dim][1]<aabb.bounds[dim][1]):
+        if (box.bounds[dim][0]>aabb.bounds[dim][0]) == (box.bounds[dim][1]<aabb.bounds[dim][1]):
           continue
 
         # Check if bounds overlap, done such that we can detect corner overlaps...
         withinCount = [0,0,0]
         for od in otherDim:
-          if event[2].bounds[od][0]>aabb.bounds[od][0] and event[2].bounds[od][0]<aabb.bounds[od][1]:
+          if box.bounds[od][0]>aabb.bounds[od][0] and box.bounds[od][0]<aabb.bounds[od][1]:
             withinCount[od] += 1
-          if event[2].bounds[od][1]>aabb.bounds[od][0] and event[2].bounds[od][1]<aabb.bounds[od][1]:
+          if box.bounds[od][1]>aabb.bounds[od][0] and box.bounds[od][1]<aabb.bounds[od][1]:
             withinCount[od] += 1
 
         if sum(withinCount)==4:
@@ -246,29 +432,34 @@ def findPortals(aabbs,overlap = 1e-3):
 
           # We have an interception - update the relevant aabb to have only the slightest overlap then create the portal and finally arrange for all the links...
           if event[0]:
-            event[2].bounds[dim][0] = aabb.bounds[dim][1] - overlap
+            box.bounds[dim][0] = aabb.bounds[dim][1] - overlap
             evSide = 0
           else:
-            event[2].bounds[dim][1] = aabb.bounds[dim][0] + overlap
+            box.bounds[dim][1] = aabb.bounds[dim][0] + overlap
             evSide = 1
           
           portal = Portal()
-          portal.fromFace(event[2],dim,not event[0])
+          portal.fromFace(box,dim,not event[0])
           ret.append(portal)
 
-          portal.aabb1 = event[2]
+          portal.aabb1 = box
           portal.aabb2 = aabb
-          event[2].portals[dim][evSide].append(portal)
+          portal.dim = dim
+          portal.side = evSide
+          box.portals[dim][evSide].append(portal)
           aabb.portals[dim][(evSide+1)%2].append(portal)
 
         elif len(filter(lambda x:x>0,withinCount))==2:
           exp = 'Partial interception - culling aabbs can not intecept at corners/edges due to undefinable behaviour - must only overlap with one face fully contained within another.'
           exp += ' dimension = ' + str(dim) + '; within = ' + str(withinCount) + '; '
-          exp += str(event[2]) + ' against ' + str(aabb)
+          exp += str(box) + ' against ' + str(aabb)
           raise Exception(exp)
 
       if event[0]:
-        # Push event - add the events aabb to the state...
-        state[id(event[2])] = event[2]
+        # Push event - add the events aabb to the active list...
+        activeKeys, activeBoxes, extent = binOf[id(box)]
+        i = bisect.bisect_right(activeKeys,box.bounds[od1][0])
+        activeKeys.insert(i,box.bounds[od1][0])
+        activeBoxes.insert(i,box)
 
   return ret
@@ -14,24 +14,35 @@
 # limitations under the License.
 
 
+import math
+
 from panda3d.core import *
 
 from aabb import *
+from cullcache import *
+from pvs import *
 
 
 class CullAABB:
   def __init__(self,manager,xml):
     self.bounds = []
     self.portals = []
+    self.dynamic = dict() # Moving nodes being tracked - node key -> [node,body,fallback parent,AABB its currently in]
     
     self.reload(manager,xml)
 
   def destroy(self):
+    for entry in self.dynamic.itervalues():
+      if not entry[0].isEmpty():
+        self.moveDynamic(entry,None)
+    self.dynamic = dict()
+
     for portal in self.portals:
-      portal.portal1 = None
-      portal.portal2 = None
-      portal.portalNode1.removeNode()
-      portal.portalNode2.removeNode()
+      if getattr(portal,'portalNode1',None)!=None:
+        portal.portal1 = None
+        portal.portal2 = None
+        portal.portalNode1.removeNode()
+        portal.portalNode2.removeNode()
       
     for aabb in self.bounds:
       children = aabb.cell.getChildren()
@@ -55,13 +66,37 @@ class CullAABB:
       levelPlugin = 'level'
     level = manager.get(levelPlugin)
 
-    # Load the AABB's into a list of bounds...
-    self.bounds = []
-    for node in level.getByIsA('CullAABB'):
-      low = Point3()
-      high = Point3()
-      node.calcTightBounds(low,high)
-      self.bounds.append(AABB(low,high))
+    # Get the physics plugin, if any, so dynamic nodes that follow bodies are updated when the physics synchs them...
+    physicsXML = xml.find('physics')
+    if physicsXML!=None:
+      self.ode = manager.get(physicsXML.get('plugin','ode'))
+    else:
+      self.ode = manager.get('ode')
+
+    # Check if we are doing visibility in Python, with a potentially visible set, rather than with Panda's portal culling...
+    pvs = xml.find('pvs')
+    if pvs!=None:
+      self.pvs = True
+      self.pvsDepth = pvs.getInt('depth',8) # Maximum number of portals to look through.
+      self.pvsAngle = pvs.getFloat('angle',10.0) # Degrees the camera can turn before the visible set is recalculated - the frustum is widened by this much to cover it.
+      self.pvsMove = pvs.getFloat('move',0.25) # Distance the camera can move before the visible set is recalculated.
+    else:
+      self.pvs = False
+
+    # Get the AABB's, portals and kd tree - from the cache made by the bake tool if its up to date, otherwise calculated from the level...
+    data = CullData()
+    thingsFile = None
+    if level.getThingsPath()!=None:
+      thingsFile = findModelFile(level.getThingsPath())
+
+    if thingsFile==None or not data.load(cacheFilename(thingsFile),fileHash(thingsFile)):
+      print 'Culling cache missing or out of date, calculating - run bake.py cull to avoid this'
+      data.calculate(level.getByIsA('CullAABB'))
+
+    self.bounds = data.bounds
+    self.portals = data.portals
+    self.kd = data.kd
+    self.cullData = data
 
     if xml.find('debug')!=None:
       print 'Found',len(self.bounds),'bounding boxes for the culling system'
@@ -70,18 +105,18 @@ class CullAABB:
     for aabb in self.bounds:
       aabb.cell = render.attachNewNode('cell')
       aabb.cell.setPos(aabb.centre[0],aabb.centre[1],aabb.centre[2])
-      aabb.cell.hide()
+      if self.pvs:
+        aabb.cell.stash()
+      else:
+        aabb.cell.hide()
 
-    # Generate a KD tree of aabb's that is used to quickly work out where a given location is in the culling structure...
-    self.kd = SetAABB(self.bounds)
-
-    # Generate the portal list...
-    self.portals = findPortals(self.bounds)
     if xml.find('debug')!=None:
+      print 'Culling kd tree:',self.kd.stats()
       print 'Found',len(self.portals),'portals for the culling system'
 
-    # Go through and create the portals - a pair for each scenario...
+    # Go through and create the portals - a pair for each scenario - not needed if we are doing the visibility ourselves...
     for portal in self.portals:
+      if self.pvs: break
       portal.portal1 = PortalNode('portal1')
       portal.portalNode1 = portal.aabb1.cell.attachNewNode(portal.portal1)
       portal.portal1.setCellIn(portal.aabb1.cell)
@@ -96,36 +131,152 @@ class CullAABB:
 
     # Setup assorted variables...
     self.camBound = None # AABB that the camera is in.
+    self.visible = [] # AABB's that are currently unstashed, in pvs mode.
+    self.visibleFrom = None # (AABB,position,forward,up) of the camera when visible was last calculated.
 
 
   def camCellUpdate(self,task):
     # Determine if the camera has moved cell, if so update cell visibility...
+    pos = base.camera.getPos(render)
+    if self.pvs:
+      return self.pvsUpdate(task,pos)
+
     if self.camBound!=None:
-      if not self.camBound.within(base.camera):
-        newBound = self.kd.within(base.camera)
+      if not self.camBound.contains(pos):
+        newBound = self.kd.locate(pos)
         if newBound!=None:
           self.camBound.cell.hide()
           self.camBound = newBound
           self.camBound.cell.show()
     else:
-      self.camBound = self.kd.within(base.camera)
+      self.camBound = self.kd.locate(pos)
       if self.camBound:
         self.camBound.cell.show()
     return task.cont
 
 
+  def pvsUpdate(self,task,pos):
+    """Visibility update for pvs mode - recalculates the set of cells that could be visible when the camera changes cell or moves or turns more than the thresholds, unstashing them and stashing the rest. If the level has baked visible sets they are used instead, so it only changes with the cell."""
+    newBound = self.kd.locate(pos)
+    if newBound!=None:
+      self.camBound = newBound
+
+    # If outside every cell show everything, as we have no idea...
+    if self.camBound==None:
+      self.setVisible(self.bounds)
+      self.visibleFrom = None
+      return task.cont
+
+    # If the bake tool has precalculated the visible sets then its just a lookup when the cell changes...
+    if self.cullData.pvs!=None:
+      if self.visibleFrom==None or self.visibleFrom[0] is not self.camBound:
+        self.visibleFrom = (self.camBound,None,None,None)
+        self.setVisible(self.cullData.visibleFrom(self.camBound))
+      return task.cont
+
+    # Check if the visible set is still good...
+    quat = base.cam.getQuat(render)
+    forward = quat.getForward()
+    up = quat.getUp()
+    if self.visibleFrom!=None:
+      bound, oldPos, oldForward, oldUp = self.visibleFrom
+      if bound is self.camBound and (pos-oldPos).length()<self.pvsMove and forward.angleDeg(oldForward)<self.pvsAngle and up.angleDeg(oldUp)<self.pvsAngle:
+        return task.cont
+    self.visibleFrom = (self.camBound,Point3(pos),forward,up)
+
+    # Get the corners of the view frustum, widened by the angle threshold, as a polygon one unit in front of the camera...
+    fov = base.camLens.getFov()
+    tx = math.tan(math.radians(min(0.5*fov[0] + self.pvsAngle,89.0)))
+    tz = math.tan(math.radians(min(0.5*fov[1] + self.pvsAngle,89.0)))
+    mat = base.cam.getMat(render)
+    corners = map(lambda c: tuple(mat.xformPoint(Point3(c[0]*tx,1.0,c[1]*tz))),[(-1,-1),(1,-1),(1,1),(-1,1)])
+
+    eye = tuple(base.cam.getPos(render))
+    self.setVisible(visibleCells(self.camBound,eye,planesThrough(eye,corners),self.pvsDepth))
+    return task.cont
+
+  def setVisible(self,aabbs):
+    """Makes the given list of AABB's the visible set, unstashing their cells and stashing those no longer visible - only touches cells that change."""
+    now = set(map(id,aabbs))
+    for aabb in self.visible:
+      if id(aabb) not in now:
+        aabb.cell.stash()
+
+    before = set(map(id,self.visible))
+    for aabb in aabbs:
+      if id(aabb) not in before:
+        aabb.cell.unstash()
+
+    self.visible = list(aabbs)
+
+  def getVisible(self):
+    """In pvs mode returns the list of AABB's currently considered visible."""
+    return self.visible
+
+
+  def dynamicAllTask(self,task):
+    """Updates all the dynamic nodes every frame - used when there is no physics plugin to say which have moved."""
+    self.dynamicUpdate(None)
+    return task.cont
+
+  def dynamicUpdate(self,moved):
+    """Moves the tracked dynamic nodes into the cells they are now in - positions are found with a single batched query, and only nodes that changed cell are reparented. Called by the physics once it has synched the nodes, with the set of node keys it set - nodes with a body that are not in it can't have moved, so are skipped. The node transforms are used rather than the bodies, as in threaded mode the nodes lag behind."""
+    entries = []
+    points = []
+    for key, entry in self.dynamic.iteritems():
+      if entry[1]!=None and moved!=None and key not in moved: continue
+      points.append(entry[0].getPos(render))
+      entries.append(entry)
+
+    for entry,bound in zip(entries,self.kd.locateMany(points)):
+      if bound is not entry[3]:
+        self.moveDynamic(entry,bound)
+
+  def moveDynamic(self,entry,bound):
+    """Internal use - reparents a dynamic node to the cell of the given AABB, or its fallback parent if None, keeping its world space position."""
+    entry[3] = bound
+    if bound!=None:
+      entry[0].wrtReparentTo(bound.cell)
+    else:
+      entry[0].wrtReparentTo(entry[2])
+
+
   def start(self):
     self.task = taskMgr.add(self.camCellUpdate,'Culling Updater')
+    if self.ode!=None:
+      self.ode.regSynchFunc('cullDynamic',self.dynamicUpdate)
+    else:
+      self.dynamicTask = taskMgr.add(self.dynamicAllTask,'Culling Dynamic',sort=110) # After anything that moves the nodes.
 
   def stop(self):
     taskMgr.remove(self.task)
+    if self.ode!=None:
+      self.ode.unregSynchFunc('cullDynamic')
+    else:
+      taskMgr.remove(self.dynamicTask)
 
   def cullStatic(self,node):
-    """Given a node path that doesn't move, or has a limited movement range known to be within an entire culling aabb, this adds it to the culling system by reparenting it to the correct cell.
+    """Given a node path that doesn't move, or has a limited movement range known to be within an entire culling aabb, this adds it to the culling system by reparenting it to the correct cell - in pvs mode it is then stashed along with the cell when the cell can't be seen.
     If there is no cell it belongs in it reparents it to render as a fallback."""
-    bound = self.kd.within(node)
+    bound = self.kd.locate(node.getPos(render))
     if bound!=None:
       node.reparentTo(bound.cell)
       node.setPos(node,-bound.cell.getPos())
     else:
       node.reparentTo(render)
+
+  def cullDynamic(self,node,body = None):
+    """Adds a moving node to the culling system - every frame it is moved to the cell it is in, so it gets culled with it. If given an ode body then the bodies position is used, and the node is not updated whilst the body is disabled. When outside all cells the node is returned to the parent it had when this was called."""
+    entry = [node,body,node.getParent(),None]
+    self.dynamic[node.getKey()] = entry
+    self.moveDynamic(entry,self.kd.locate(node.getPos(render)))
+
+  def uncullDynamic(self,node):
+    """Removes a node added with cullDynamic, returning it to the parent it had when it was added. Must be called before the node is removed."""
+    entry = self.dynamic.pop(node.getKey(),None)
+    if entry!=None:
+      self.moveDynamic(entry,None)
+
+  def locateMany(self,points):
+    """Given a list of positions in world space returns a list, aligned with it, of the cell NodePath each is in, or None if outside every cell. Vectorised if numpy is avaliable, so suitable for binning lots of objects every frame."""
+    return map(lambda b: b.cell if b!=None else None,self.kd.locateMany(points))
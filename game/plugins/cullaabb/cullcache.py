@@ -0,0 +1,125 @@
+# Copyright Tom SF Haines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import cPickle
+
+import direct.stdpy.file as pfile
+from panda3d.core import *
+
+from bin.shared.modelfile import *
+from aabb import *
+from pvs import bakeVisibility
+
+
+# Bump whenever the format of the cache changes, so old files get rebuilt...
+cullCacheVersion = 2
+
+
+
+def cacheFilename(modelFile):
+  """Returns the filename of the culling cache that goes with a things file - it sits next to it, with the extension replaced by .cull"""
+  for ext in reversed(modelExtensions[1:]):
+    if modelFile.endswith(ext):
+      return modelFile[:-len(ext)] + '.cull'
+  return modelFile + '.cull'
+
+
+
+class CullData:
+  """The culling structure of a level - the list of AABB's, with the portals between them and the kd tree for finding which a point is in, plus optionally the potentially visible set of each AABB. Can be calculated from the things of a level, or loaded from a cache file made by the bake tool. Each AABB gets an index variable, its position in bounds."""
+  def __init__(self):
+    self.bounds = []
+    self.portals = []
+    self.kd = None
+    self.pvs = None # None, or list aligned with bounds of bitsets - see pvs.bakeVisibility.
+
+  def calculate(self,nodes):
+    """Calculates everything from a list of NodePaths, one per culling AABB. Throws an exception if the geometry is bad."""
+    self.bounds = []
+    for node in nodes:
+      low = Point3()
+      high = Point3()
+      node.calcTightBounds(low,high)
+      self.bounds.append(AABB(low,high))
+      self.bounds[-1].index = len(self.bounds)-1
+
+    # Portals before the kd tree, as finding them adjusts the bounds...
+    self.portals = findPortals(self.bounds)
+    self.kd = SetAABB(self.bounds)
+    self.pvs = None
+
+  def calculateVisibility(self,samples = 3,maxDepth = 32):
+    """Calculates the potentially visible sets - slow, so only done by the bake tool."""
+    self.pvs = bakeVisibility(self.bounds,samples,maxDepth)
+
+  def visibleFrom(self,aabb):
+    """Returns the list of AABB's potentially visible from the given AABB, or None if the visible sets have not been calculated."""
+    if self.pvs==None:
+      return None
+    bits = self.pvs[aabb.index]
+    return filter(lambda a: (bits>>a.index)&1,self.bounds)
+
+  def save(self,filename,sourceHash):
+    """Writes it to the given cache file, keyed by the hash of the file it was calculated from."""
+    index = dict()
+    for i,aabb in enumerate(self.bounds):
+      index[id(aabb)] = i
+
+    bounds = map(lambda a: (tuple(a.x),tuple(a.y),tuple(a.z),a.centre),self.bounds)
+    portals = map(lambda p: (map(tuple,p.verts),index[id(p.aabb1)],index[id(p.aabb2)],p.dim,p.side),self.portals)
+    data = (cullCacheVersion,sourceHash,bounds,portals,self.kd.getState(),self.pvs)
+
+    f = open(filename,'wb')
+    try:
+      cPickle.dump(data,f,cPickle.HIGHEST_PROTOCOL)
+    finally:
+      f.close()
+
+  def load(self,filename,sourceHash):
+    """Loads it from the given cache file - returns True on success, False if the file is missing, out of date or from a different source file."""
+    try:
+      f = pfile.open(filename,'rb')
+      try:
+        version, h, bounds, portals, kdState, pvs = cPickle.loads(f.read())
+      finally:
+        f.close()
+    except (IOError,EOFError,ValueError,cPickle.UnpicklingError):
+      return False
+    if version!=cullCacheVersion or h!=sourceHash:
+      return False
+
+    self.bounds = []
+    for x,y,z,centre in bounds:
+      aabb = AABB((x[0],y[0],z[0]),(x[1],y[1],z[1]))
+      aabb.index = len(self.bounds)
+      aabb.centre = centre # Calculated before the portals adjusted the bounds, so has to be stored.
+      aabb.portals = [[[],[]],[[],[]],[[],[]]]
+      self.bounds.append(aabb)
+
+    self.portals = []
+    for verts,i1,i2,dim,side in portals:
+      portal = Portal()
+      portal.verts = map(list,verts)
+      portal.aabb1 = self.bounds[i1]
+      portal.aabb2 = self.bounds[i2]
+      portal.dim = dim
+      portal.side = side
+      portal.aabb1.portals[dim][side].append(portal)
+      portal.aabb2.portals[dim][(side+1)%2].append(portal)
+      self.portals.append(portal)
+
+    self.kd = SetAABB(self.bounds,kdState)
+    self.pvs = pvs
+    return True
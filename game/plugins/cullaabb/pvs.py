@@ -0,0 +1,146 @@
+# Copyright Tom SF Haines
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import math
+
+
+# Helpers for 3D vectors stored as tuples...
+def sub(a,b):
+  return (a[0]-b[0],a[1]-b[1],a[2]-b[2])
+
+def dot(a,b):
+  return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+
+def cross(a,b):
+  return (a[1]*b[2]-a[2]*b[1],a[2]*b[0]-a[0]*b[2],a[0]*b[1]-a[1]*b[0])
+
+
+
+def planesThrough(eye,poly):
+  """Given an eye position and a convex polygon, as a list of vertices, returns the planes through the eye and each edge of the polygon - the sides of the pyramid with its apex at the eye and the polygon as its base. Planes are (normal,offset) pairs, oriented so that points inside the pyramid are on the positive side."""
+  centre = map(lambda d: sum(map(lambda v: v[d],poly))/float(len(poly)),xrange(3))
+  ret = []
+  for i in xrange(len(poly)):
+    n = cross(sub(poly[i],eye),sub(poly[(i+1)%len(poly)],eye))
+    length = math.sqrt(dot(n,n))
+    if length<1e-9: continue
+    n = (n[0]/length,n[1]/length,n[2]/length)
+    d = -dot(n,eye)
+    if dot(n,centre)+d<0.0:
+      n = (-n[0],-n[1],-n[2])
+      d = -d
+    ret.append((n,d))
+  return ret
+
+
+def clipPolygon(poly,planes):
+  """Clips a convex polygon, a list of vertices, against a list of planes as returned by planesThrough, keeping the parts on the positive side of them all. Returns the clipped polygon, or an empty list if nothing is left."""
+  for n,d in planes:
+    out = []
+    for i in xrange(len(poly)):
+      a = poly[i]
+      b = poly[(i+1)%len(poly)]
+      da = dot(n,a) + d
+      db = dot(n,b) + d
+      if da>=0.0:
+        out.append(a)
+      if (da>=0.0)!=(db>=0.0):
+        t = da/(da-db)
+        out.append((a[0]+t*(b[0]-a[0]),a[1]+t*(b[1]-a[1]),a[2]+t*(b[2]-a[2])))
+    poly = out
+    if len(poly)<3:
+      return []
+  return poly
+
+
+
+def visibleCells(start,eye,planes,maxDepth,nearDist = 1e-2,maxWork = 4096):
+  """Given the AABB containing the eye, the eye position and the planes of the view frustum, as returned by planesThrough, this returns a list of the AABB's that could be visible. It traverses the portal graph, as made by findPortals, clipping each portal by the frustum it is seen through and narrowing the frustum to what is left. Does not go more than maxDepth portals deep. Portals the eye is within nearDist of are passed through without clipping, as they are too close to narrow the frustum reliably. A portal is not passed through again in the same direction if it has already been with a frustum at least as wide and at least as much depth left, as a line of sight can't go any further the second time - this keeps dense portal graphs from being explored along every path. If it still passes through more than maxWork portals it stops narrowing the frustum, so the answer remains conservative, if less tight."""
+  visible = dict()
+  visible[id(start)] = start
+  seen = dict() # (id(portal),id(aabb entered)) -> list of (frustum planes,depth) it has been passed through with.
+  work = [0]
+
+  def covered(key,poly,depth):
+    for oldPlanes, oldDepth in seen.get(key,[]):
+      if oldDepth>depth: continue
+      inside = True
+      for n,d in oldPlanes:
+        for v in poly:
+          if dot(n,v)+d<-1e-6:
+            inside = False
+            break
+        if not inside: break
+      if inside: return True
+    return False
+
+  def visit(aabb,planes,depth,path):
+    if depth>=maxDepth: return
+    for dim in xrange(3):
+      for side in xrange(2):
+        for portal in aabb.portals[dim][side]:
+          if portal.aabb1 is aabb:
+            other = portal.aabb2
+          else:
+            other = portal.aabb1
+          if id(other) in path: continue
+
+          # The eye has to be in front of the portal to see through it...
+          dist = eye[dim] - portal.verts[0][dim]
+          if side==1: dist = -dist
+          if dist<-nearDist: continue
+
+          if dist<nearDist:
+            poly = portal.verts
+            inner = planes
+          else:
+            poly = clipPolygon(portal.verts,planes)
+            if len(poly)==0: continue
+            inner = planesThrough(eye,poly)
+          if work[0]>=maxWork:
+            inner = [] # Out of work - stop narrowing, so everything reachable is included.
+
+          # Skip it if we have already been through it at least as well...
+          key = (id(portal),id(other))
+          if covered(key,poly,depth+1): continue
+          seen.setdefault(key,[]).append((inner,depth+1))
+          work[0] += 1
+
+          visible[id(other)] = other
+          visit(other,inner,depth+1,path + (id(other),))
+
+  visit(start,planes,0,(id(start),))
+  return visible.values()
+
+
+def bakeVisibility(aabbs,samples = 3,maxDepth = 32):
+  """Precalculates the potentially visible set of every AABB, by sampling a grid of samples^3 viewpoints within each and finding everything visible from them in any direction, through the portals. Returns a list aligned with aabbs of bitsets, as integers, where bit i is set if aabbs[i] could be visible from within that AABB."""
+  index = dict()
+  for i,aabb in enumerate(aabbs):
+    index[id(aabb)] = i
+
+  fractions = map(lambda k: (k+0.5)/samples,xrange(samples))
+  ret = []
+  for aabb in aabbs:
+    bits = 0
+    for fx in fractions:
+      for fy in fractions:
+        for fz in fractions:
+          f = (fx,fy,fz)
+          eye = tuple(map(lambda d: aabb.bounds[d][0] + f[d]*(aabb.bounds[d][1]-aabb.bounds[d][0]),xrange(3)))
+          for other in visibleCells(aabb,eye,[],maxDepth):
+            bits |= 1<<index[id(other)]
+    ret.append(bits)
+  return ret
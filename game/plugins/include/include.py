@@ -14,11 +14,9 @@
 
 
 
-import xml.etree.ElementTree as et
-
 
 class Include:
-  """Meta plugin that allows you to include other config files, will be declared as <obj type="Include" config="other"/> A name is not needed."""
+  """Meta plugin that allows you to include other config files, will be declared as <obj type="Include" config="other"/> A name is not needed. During transitions the manager expands these inline itself, so that included objects can be made concurrently with the rest of the config - this class only gets used when an Include is handed directly to Manager.addObj."""
   def __init__(self,manager,xml):
     self.manager = manager
     
@@ -26,11 +24,10 @@ class Include:
     self.config = xml.get('config')
 
   def postInit(self):
-    # Load the configuration xml file...
-    elem = et.parse(self.manager.configDir+self.config+'.xml')
+    # Get the configuration from the managers compiled config cache...
+    objs = self.manager.expandConfig(self.config)
     yield None
     
-    # Iterate the relevant elements and use the manager to load them all...
-    for obj in elem.findall('obj'):
-      for blah in self.manager.addObj(obj):
-        yield None
+    # Use the manager to load all the relevant elements...
+    for blah in self.manager.addObjs(objs):
+      yield None
@@ -21,19 +21,21 @@ from panda3d.core import *
 from panda3d.ode import *
 from direct.showbase import DirectObject
 from direct.showbase.ShowBase import ShowBase
+from direct.stdpy import threading
 
 
 class InitODE(DirectObject.DirectObject):
-  """This creates the various ODE core objects, and exposes them to other plugins. Should be called ode."""
+  """This creates the various ODE core objects, and exposes them to other plugins. Should be called ode.
+  If given a <thread/> tag the simulation runs on its own thread, so it overlaps with rendering. The nodes are then set from snapshots of the bodies taken after each step, interpolated between the last two to match the render time, so they lag by up to a step. The physics lock is held by the main thread from the start of each frame until just before rendering, so tasks can touch bodies as usual during that time; pre and post functions run on the physics thread, so must not touch NodePaths - nodes that follow bodies should be registered with regBodySynch, and anything else the main thread sets up should be copied somewhere by a task first. As ODE calls hold the python GIL the gain comes from the simulation running whilst Panda renders, which releases it - python heavy callbacks will still contend with the main thread."""
   def __init__(self,manager,xml):
     # Setup the physics world...
-    erp = float(xml.find('param').get('erp',0.8))
-    cfm = float(xml.find('param').get('cfm',1e-3))
-    slip = float(xml.find('param').get('slip',0.0))
-    dampen = float(xml.find('param').get('dampen',0.1))
+    erp = xml.find('param').getFloat('erp',0.8)
+    cfm = xml.find('param').getFloat('cfm',1e-3)
+    slip = xml.find('param').getFloat('slip',0.0)
+    dampen = xml.find('param').getFloat('dampen',0.1)
     
     self.world = OdeWorld()
-    self.world.setGravity(float(xml.find('gravity').get('x',0.0)), float(xml.find('gravity').get('y',0.0)), float(xml.find('gravity').get('z',-9.81)))
+    self.world.setGravity(xml.find('gravity').getFloat('x',0.0), xml.find('gravity').getFloat('y',0.0), xml.find('gravity').getFloat('z',-9.81))
     self.world.setErp(erp)
     self.world.setCfm(cfm)
     self.world.setAutoDisableFlag(True)
@@ -48,16 +50,16 @@ class InitODE(DirectObject.DirectObject):
       # Maths used below is obviously wrong - should probably work out something better.
 
       # Interaction with same surface...
-      mu = float(surElem[a].get('mu'))
-      bounce = float(surElem[a].get('bounce'))
-      absorb = float(surElem[a].get('absorb'))
+      mu = surElem[a].getFloat('mu')
+      bounce = surElem[a].getFloat('bounce')
+      absorb = surElem[a].getFloat('absorb')
       self.world.setSurfaceEntry(a,a,mu,bounce,absorb,erp,cfm,slip,dampen)
 
       # Interaction with other surfaces...
       for b in xrange(a+1,len(surElem)):
-        mu = float(surElem[a].get('mu')) * float(surElem[b].get('mu'))
-        bounce = float(surElem[a].get('bounce')) * float(surElem[b].get('bounce'))
-        absorb = float(surElem[a].get('absorb')) + float(surElem[b].get('absorb'))
+        mu = surElem[a].getFloat('mu') * surElem[b].getFloat('mu')
+        bounce = surElem[a].getFloat('bounce') * surElem[b].getFloat('bounce')
+        absorb = surElem[a].getFloat('absorb') + surElem[b].getFloat('absorb')
         self.world.setSurfaceEntry(a,b,mu,bounce,absorb,erp,cfm,slip,dampen)
 
     # Create a space to manage collisions...
@@ -77,47 +79,112 @@ class InitODE(DirectObject.DirectObject):
     # Create the extra function databases - pre- and post- functions for before and after each collision step...
     self.preCollide = dict() # id(func) -> func
     self.postCollide = dict()
+    self.synchFuncs = dict() # name -> func(keys), called on the main thread once the nodes have been synched each frame.
+
+    # Create the trimesh database - collision meshes loaded from files, shared between everything that uses the same file...
+    self.triMesh = dict() # filename -> [OdeTriMeshData,reference count,low corner,high corner]
 
     # Create the damping database - damps objects so that they slow down over time, which is very good for stability...
-    self.damping = dict() # id(body) -> (body,amount)
+    self.damping = dict() # node key -> (body,linear,angular)
+
+    # Create the awake database - every body registered for synching or damping, indexed by the same key, plus those that are enabled. Only awake bodies are damped and synched, so the per step cost follows what is actually moving. Bodies should be woken with wake, but those woken by anything else are caught by their collisions or by checking a few sleeping bodies each frame...
+    self.bodies = dict() # key -> body
+    self.bodyKeys = None # List of the keys of bodies, for the scan - None when it needs remaking.
+    self.awake = dict() # key -> body
+    self.scanNext = 0
+    awake = xml.find('awake')
+    if awake!=None:
+      self.scanRate = awake.getInt('scan',16) # Sleeping bodies checked per frame.
+    else:
+      self.scanRate = 16
 
     # Variables for the physics simulation to run on automatic - start and stop are used to enable/disable it however...
     self.timeRem = 0.0
     self.step = 1.0/50.0
+
+    # Limits on the work done each frame - no more than maxSteps steps, with simulated time dropped rather than trying to catch up when that is not enough, and the quickStep iteration count adapted so the steps fit in a real time budget...
+    steps = xml.find('steps')
+    if steps!=None:
+      self.maxSteps = steps.getInt('max',5)
+      self.stepBudget = steps.getFloat('budget',0.01) # Seconds per frame.
+      self.maxIterations = steps.getInt('iterations',20)
+      self.minIterations = steps.getInt('min',4)
+    else:
+      self.maxSteps = 5
+      self.stepBudget = 0.01
+      self.maxIterations = 20
+      self.minIterations = 4
+    self.iterations = self.maxIterations
+    self.world.setQuickStepNumIterations(self.iterations)
+    self.stepTime = 0.0 # Exponential moving average of the real time taken by a step.
+    self.lastAdapt = 0 # simSteps when the iterations were last changed.
+    self.droppedTime = 0.0 # Total simulated time skipped due to the step limit.
+
+    # Real time spent simulating, for profiling - total and step count since creation, plus the time taken by the last frame...
+    self.simTime = 0.0
+    self.simSteps = 0
+    self.lastSimTime = 0.0
     
     # Arrange variables for collision callback, enable the callbacks...
     self.collCB = dict() # OdeGeom to func(entry,flag), where flag is False if its in 1, true if its in 2.
     self.space.setCollisionEvent("collision")
 
+    # Threading - the lock, held by whichever thread is using the physics, and the last two snapshots of body positions, as (time,dict of key -> (position,quaternion)), oldest first...
+    self.threaded = xml.find('thread')!=None
+    self.lock = threading.Lock()
+    self.locked = False # True if the main thread holds the lock.
+    self.running = False
+    self.thread = None
+    self.snapshots = (None,None)
+
 
   def reload(self,manager,xml):
     pass # No-op: This makes this module incorrect, but only because you can't change the configuration during runtime without unloading it first. Physics setup tends to remain constant however.
 
 
   def simulationTask(self,task):
-    # Step the simulation and set the new positions - fixed time step...
-    self.timeRem += globalClock.getDt()
+    # Step the simulation and set the new positions...
+    self.simulate(globalClock.getDt())
+
+    # Update the nodes of awake bodies to have their positions updated - those that have gone to sleep get one last update and then leave the awake set...
+    moved = set()
+    for key, body in self.awake.items():
+      data = self.synch.get(key)
+      if data!=None:
+        data[0].setPosQuat(render,body.getPosition(),Quat(body.getQuaternion()))
+        moved.add(key)
+      if not body.isEnabled():
+        del self.awake[key]
+
+    self.callSynchFuncs(moved)
+    return task.cont
+
+
+  def simulate(self,dt):
+    """Internal use - advances the simulation by the given time, in fixed size steps. Returns how many steps it took."""
+    self.timeRem += dt
+    simStart = globalClock.getRealTime()
+
+    # Check a few bodies for having woken up without us noticing, then get the awake ones that need damping...
+    self.scanBodies()
+    damped = [self.damping[key] for key in self.awake if key in self.damping]
+
+    steps = 0
     while self.timeRem>self.step:
+      # If we are too far behind slow the simulation down, rather than spiral into ever slower frames trying to catch up...
+      if steps>=self.maxSteps:
+        drop = self.timeRem - math.fmod(self.timeRem,self.step)
+        self.droppedTime += drop
+        self.timeRem -= drop
+        break
+      stepStart = globalClock.getRealTime()
+
       # Call the pre-collision functions...
       for ident,func in self.preCollide.iteritems():
         func()
 
-      # Apply damping to all objects in damping db...
-      for key,data in self.damping.iteritems():
-        if data[0].isEnabled():
-          vel = data[0].getLinearVel()
-          if vel.length()>1e3: # Cap dangerous motion.
-            data[0].setLinearVel(vel*(1e3/vel.length()))
-          else:
-            vel *= -data[1]
-            data[0].addForce(vel)
-
-          rot = data[0].getAngularVel()
-          if rot.length()>1e3: # Cap dangerous rotation.
-            data[0].setAngularVel(rot*(1e3/rot.length()))
-          else:
-            rot *= -data[2]
-            data[0].addTorque(rot)
+      # Apply damping to the awake objects in the damping db...
+      self.applyDamping(damped)
 
       # A single step of collision detection...
       self.space.autoCollide() # Setup the contact joints
@@ -129,15 +196,175 @@ class InitODE(DirectObject.DirectObject):
       for ident,func in self.postCollide.iteritems():
         func()
 
-    # Update all objects registered with this class to have their positions updated...
-    for key, data in self.synch.items():
-      node, body = data
-      node.setPosQuat(render,body.getPosition(),Quat(body.getQuaternion()))
+      self.simSteps += 1
+      steps += 1
+      self.stepTime = 0.9*self.stepTime + 0.1*(globalClock.getRealTime()-stepStart)
+
+    if steps!=0:
+      self.adaptIterations(steps)
+
+    self.lastSimTime = globalClock.getRealTime() - simStart
+    self.simTime += self.lastSimTime
+    return steps
+
+
+  def physicsThread(self):
+    """The loop run by the physics thread in threaded mode - simulates whenever it can get the lock, snapshotting the bodies after any steps, then sleeps until the next step is due. Driven by the frame time, same as the unthreaded mode, so it follows the clock when its not running in real time."""
+    last = globalClock.getFrameTime()
+    while self.running:
+      self.lock.acquire()
+      try:
+        now = globalClock.getFrameTime()
+        if self.simulate(now-last)!=0:
+          self.snapshot(now-self.timeRem)
+        last = now
+        wait = self.step - self.timeRem
+      finally:
+        self.lock.release()
+      Thread.sleep(max(wait,1e-3))
+
+  def snapshot(self,t):
+    """Internal use - records the position and orientation of the awake bodies that have nodes, as the state at time t. Bodies that have gone to sleep are included one last time, then leave the awake set."""
+    snap = dict()
+    for key, body in self.awake.items():
+      if self.synch.has_key(key):
+        snap[key] = (Point3(body.getPosition()),Quat(body.getQuaternion()))
+      if not body.isEnabled():
+        del self.awake[key]
+    self.snapshots = (self.snapshots[1],(t,snap))
+
+  def lockTask(self,task):
+    """Start of frame in threaded mode - takes the lock, so the other tasks can use the physics."""
+    if not self.locked:
+      self.lock.acquire()
+      self.locked = True
+    return task.cont
 
+  def unlockTask(self,task):
+    """Just before rendering in threaded mode - sets the nodes from the snapshots, interpolated to the current time, then lets the physics thread have the lock whilst Panda renders."""
+    prev, curr = self.snapshots
+    moved = set()
+    if curr!=None:
+      # The snapshots can be several steps apart, so interpolate over the actual gap between them...
+      if prev!=None:
+        before = prev[1]
+        gap = max(curr[0]-prev[0],self.step)
+      else:
+        before = dict()
+        gap = self.step
+      alpha = min(max((globalClock.getFrameTime()-curr[0])/gap,0.0),1.0)
+
+      for key, (pos,quat) in curr[1].iteritems():
+        data = self.synch.get(key)
+        if data==None: continue
+        if before.has_key(key):
+          pos0, quat0 = before[key]
+          if quat0.dot(quat)<0.0:
+            quat0 = quat0 * -1.0
+          pos = pos0 + (pos-pos0)*alpha
+          quat = Quat(quat0*(1.0-alpha) + quat*alpha)
+          quat.normalize()
+        data[0].setPosQuat(render,pos,quat)
+        moved.add(key)
+
+      # Bodies that have left the snapshots get their final position...
+      for key, (pos,quat) in before.iteritems():
+        if not curr[1].has_key(key) and self.synch.has_key(key):
+          self.synch[key][0].setPosQuat(render,pos,quat)
+          moved.add(key)
+
+    # Still holding the lock, so the synch functions see the physics thread leave everything alone...
+    self.callSynchFuncs(moved)
+
+    if self.locked:
+      self.locked = False
+      self.lock.release()
     return task.cont
 
 
+  def callSynchFuncs(self,moved):
+    """Internal use - calls the synch functions with the set of node keys that have just been set."""
+    for name,func in self.synchFuncs.items():
+      func(moved)
+
+
+  def adaptIterations(self,steps):
+    """Internal use - given the number of steps this frame adjusts the quickStep iteration count - reduced when the steps are taking longer than the budget, increased back towards the configured count when there is plenty of time. Waits for the step time average to settle between changes."""
+    if self.simSteps-self.lastAdapt<10:
+      return
+
+    needed = self.stepTime*steps
+    if needed>self.stepBudget and self.iterations>self.minIterations:
+      self.iterations = max(int(self.iterations*0.75),self.minIterations)
+    elif needed<0.5*self.stepBudget and self.iterations<self.maxIterations:
+      self.iterations += 1
+    else:
+      return
+
+    self.world.setQuickStepNumIterations(self.iterations)
+    self.lastAdapt = self.simSteps
+
+  def applyDamping(self,damped):
+    """Internal use - applies damping to a list of (body,linear,angular), capping dangerous motion. Done a body at a time, as every body has to be read and written through its own ODE call whatever maths is used in between - the saving comes from only passing in the awake bodies."""
+    for body,linear,angular in damped:
+      if not body.isEnabled(): continue # The list is made once per frame, so bodies that go to sleep between steps must not gather forces.
+
+      vel = body.getLinearVel()
+      if vel.length()>1e3: # Cap dangerous motion.
+        body.setLinearVel(vel*(1e3/vel.length()))
+      else:
+        vel *= -linear
+        body.addForce(vel)
+
+      rot = body.getAngularVel()
+      if rot.length()>1e3: # Cap dangerous rotation.
+        body.setAngularVel(rot*(1e3/rot.length()))
+      else:
+        rot *= -angular
+        body.addTorque(rot)
+
+
+  def scanBodies(self):
+    """Internal use - checks the next few registered bodies, round robin, adding any that are enabled to the awake set."""
+    if self.bodyKeys==None:
+      self.bodyKeys = self.bodies.keys()
+    for i in xrange(min(self.scanRate,len(self.bodyKeys))):
+      self.scanNext = (self.scanNext+1) % len(self.bodyKeys)
+      key = self.bodyKeys[self.scanNext]
+      if self.bodies[key].isEnabled():
+        self.awake[key] = self.bodies[key]
+
+  def noteAwake(self,body):
+    """Internal use - if the given body is registered and enabled makes sure it is in the awake set."""
+    if body.isEmpty() or not body.isEnabled():
+      return
+    node = body.getData()
+    if isinstance(node,NodePath) and self.bodies.has_key(node.getKey()):
+      self.awake[node.getKey()] = body
+
+  def track(self,key,body):
+    """Internal use - adds a body to the awake database."""
+    self.bodies[key] = body
+    self.bodyKeys = None
+    if body.isEnabled():
+      self.awake[key] = body
+
+  def untrack(self,key):
+    """Internal use - removes a body from the awake database, unless its still registered for something."""
+    if self.synch.has_key(key) or self.damping.has_key(key):
+      return
+    if self.bodies.has_key(key):
+      del self.bodies[key]
+      self.bodyKeys = None
+    if self.awake.has_key(key):
+      del self.awake[key]
+
+
   def onCollision(self,entry):
+    # Bodies woken up by being hit by an awake body need to join the awake set...
+    self.noteAwake(entry.getBody1())
+    self.noteAwake(entry.getBody2())
+
     geom1 = entry.getGeom1()
     geom2 = entry.getGeom2()
 
@@ -149,13 +376,31 @@ class InitODE(DirectObject.DirectObject):
 
 
   def start(self):
-    self.task = taskMgr.add(self.simulationTask,'Physics Sim',sort=100)
+    if self.threaded:
+      self.snapshots = (None,None)
+      self.task = taskMgr.add(self.lockTask,'Physics Lock',sort=-1000)
+      self.unlock = taskMgr.add(self.unlockTask,'Physics Unlock',sort=45) # Before igLoop.
+      self.running = True
+      self.thread = threading.Thread(target=self.physicsThread,name='Physics')
+      self.thread.start()
+    else:
+      self.task = taskMgr.add(self.simulationTask,'Physics Sim',sort=100)
     self.accept("collision",self.onCollision)
 
   def stop(self):
     taskMgr.remove(self.task)
     del self.task
 
+    if self.thread!=None:
+      taskMgr.remove(self.unlock)
+      del self.unlock
+      self.running = False
+      if self.locked:
+        self.locked = False
+        self.lock.release()
+      self.thread.join()
+      self.thread = None
+
     self.timeRem = 0.0
     self.ignoreAll()
 
@@ -182,29 +427,56 @@ class InitODE(DirectObject.DirectObject):
   def getRemTime(self):
     return self.timeRem
 
+  def isThreaded(self):
+    """Returns True if the simulation runs on its own thread."""
+    return self.threaded
+
+  def getLock(self):
+    """Returns the lock that must be held to use the physics from another thread, in threaded mode. Not needed by tasks that run before rendering, as the main thread already holds it then."""
+    return self.lock
+
+  def getIterations(self):
+    """Returns the number of iterations quickStep is currently using."""
+    return self.iterations
+
+  def getDroppedTime(self):
+    """Returns the total simulated time that has been skipped because frames needed more than the maximum number of steps."""
+    return self.droppedTime
+
 
   def regBodySynch(self,node,body):
     """Given a NodePath and a Body this arranges that the NodePath tracks the Body."""
     body.setData(node)
     self.synch[node.getKey()] = (node,body)
+    self.track(node.getKey(),body)
 
   def unregBodySynch(self,node):
     """Removes a NodePath/Body pair from the synchronisation database, so the NodePath will stop automatically tracking the Body."""
     if self.synch.has_key(node.getKey()):
       self.synch[node.getKey()][1].setData(None)
       del self.synch[node.getKey()]
+      self.untrack(node.getKey())
 
   def regPreFunc(self,name,func):
-    """Registers a function under a unique name to be called before every step of the physics simulation - this is different from every frame, being entirly regular."""
+    """Registers a function under a unique name to be called before every step of the physics simulation - this is different from every frame, being entirly regular. In threaded mode it is called on the physics thread, so it must only touch the physics, never NodePaths."""
     self.preCollide[name] = func
 
+  def wake(self,body):
+    """Enables a body if it is asleep - use this rather than enabling a body directly, so it is damped and synched straight away."""
+    body.enable()
+    self.noteAwake(body)
+
+  def getBodyCounts(self):
+    """Returns (awake,sleeping,total) for the bodies registered for synching or damping. A body that has just gone to sleep counts as awake until the end of the frame."""
+    return (len(self.awake),len(self.bodies)-len(self.awake),len(self.bodies))
+
   def unregPreFunc(self,name):
     """Unregisters a function to be called every step, by name."""
     if self.preCollide.has_key(name):
       del self.preCollide[name]
 
   def regPostFunc(self,name,func):
-    """Registers a function under a unique name to be called after every step of the physics simulation - this is different from every frame, being entirly regular."""
+    """Registers a function under a unique name to be called after every step of the physics simulation - this is different from every frame, being entirly regular. In threaded mode it is called on the physics thread, so it must only touch the physics, never NodePaths - use regBodySynch to have a node follow a body."""
     self.postCollide[name] = func
 
   def unregPostFunc(self,name):
@@ -212,6 +484,15 @@ class InitODE(DirectObject.DirectObject):
     if self.postCollide.has_key(name):
       del self.postCollide[name]
 
+  def regSynchFunc(self,name,func):
+    """Registers a function under a unique name to be called every frame on the main thread, once the nodes registered with regBodySynch have been moved to match their bodies - it is given the set of node keys (getKey()) that were set this frame. In threaded mode this is whilst the physics lock is still held, so it is the place to follow the synched nodes, as they lag behind the bodies."""
+    self.synchFuncs[name] = func
+
+  def unregSynchFunc(self,name):
+    """Unregisters a synch function, by name."""
+    if self.synchFuncs.has_key(name):
+      del self.synchFuncs[name]
+
   def regCollisionCB(self,geom,func):
     """Registers a callback that will be called whenever the given geom collides. The function must take an OdeCollisionEntry followed by a flag, which will be False if geom1 is the given geom, True if its geom2."""
     self.collCB[geom] = func
@@ -224,9 +505,49 @@ class InitODE(DirectObject.DirectObject):
   def regDamping(self,body,linear,angular):
     """Given a body this applies a damping force, such that the velocity and rotation will be reduced in time. If the body is already registered this will update the current setting."""
     self.damping[body.getData().getKey()] = (body,linear,angular)
-
-  def unregDampingl(self,body):
+    self.track(body.getData().getKey(),body)
+
+  def getTriMeshData(self,filename,model = None):
+    """Returns the OdeTriMeshData for a collision mesh file, loading it on first request and sharing it thereafter, so memory scales with the number of unique meshes not the number of objects. If the caller has already loaded the file, e.g. asynchronously, it can pass the model in to save loading it again - the model is used up either way. Every call must be matched by a call to releaseTriMeshData, after the geoms using it have been destroyed."""
+    entry = self.triMesh.get(filename)
+    if entry==None:
+      if model!=None:
+        colMesh = model
+      else:
+        colMesh = loader.loadModel(filename)
+      low, high = colMesh.getTightBounds()
+      entry = [OdeTriMeshData(colMesh,True),0,low,high]
+      colMesh.removeNode()
+      self.triMesh[filename] = entry
+    elif model!=None:
+      model.removeNode()
+    entry[1] += 1
+    return entry[0]
+
+  def getTriMeshBounds(self,filename):
+    """Returns (low,high), the corners of the axis aligned bounding box of a collision mesh obtained with getTriMeshData."""
+    entry = self.triMesh[filename]
+    return (entry[2],entry[3])
+
+  def releaseTriMeshData(self,filename):
+    """Releases a reference obtained with getTriMeshData - when the last one goes the data is freed."""
+    entry = self.triMesh.get(filename)
+    if entry!=None:
+      entry[1] -= 1
+      if entry[1]<=0:
+        del self.triMesh[filename]
+
+  def unregDamping(self,body):
     """Unregisters a body from damping."""
-    key = body.getId()
-    if self.damping.has_key(key):
-      del self.air_resist[key]
+    node = body.getData()
+    if isinstance(node,NodePath) and self.damping.has_key(node.getKey()):
+      del self.damping[node.getKey()]
+      self.untrack(node.getKey())
+      return
+
+    for key,data in self.damping.items():
+      if data[0]==body:
+        del self.damping[key]
+        self.untrack(key)
+
+  unregDampingl = unregDamping # Original misspelt name, kept for compatibility.
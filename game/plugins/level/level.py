@@ -16,24 +16,34 @@
 
 
 import posixpath
-import time
 
 from panda3d.core import *
 from direct.showbase.ShowBase import ShowBase
 
+import direct.stdpy.file as pfile
+
 from bin.shared import odeSpaceHier
+from bin.shared.modelfile import findModelFile
+from bin.shared.assets import getAssets
 
 
 class Level:
   """This loads a level - that is it loads a collection fo egg files and sticks them at the origin. These files will typically be very large. 4 files, all optional, are typically given - the rendered file, the collision file, the detail file (Visible instances of high res geometry.) and the entity file. (Lots of empties used by the programmer.)"""
   def __init__(self,manager,xml):
+    self.rend = None
+    self.things = None
+    self.assetFiles = [] # Filenames obtained from the asset cache, to be released.
     self.reload(manager,xml)
 
+  def destroy(self):
+    self.releaseAssets()
+
   def reload(self,manager,xml):
     # Load from the xml the details needed to do the actual loading...
     
-    # Get the path to load levels from...
+    # Get the path to load levels from, and the cache directory - the managers, as it has been resolved against the base directory...
     basePath = manager.get('paths').getConfig().find('levels').get('path')
+    self.cacheDir = manager.cacheDir
 
     # Get the details for the renderable geometry...
     rendElem = xml.find('render')
@@ -48,6 +58,9 @@ class Level:
     if colElem!=None:
       self.colPath = posixpath.join(basePath,colElem.get('filename'))
       self.colSurface = colElem.get('surface','default')
+      self.colLayout = colElem.get('layout') # 'balanced' to cluster the triangles spatially, 'egg' to copy the egg's structure, None for balanced only if the clusters have already been cached (e.g. by bake.py), as making them is slow.
+      self.colTriangles = colElem.getInt('triangles',256) # Target triangles per tri-mesh when balanced.
+      self.colSpace = colElem.get('space','quadtree') # 'quadtree' or 'hash', for when balanced.
     else:
       self.colPath = None
 
@@ -66,20 +79,57 @@ class Level:
       odeName = 'ode'
     self.ode = manager.get(odeName)
 
+    # Models come from the asset cache, so they survive transitions...
+    self.assets = getAssets(manager,xml)
+
 
   def postInit(self):
     for i in self.postReload():
       yield i
 
   def postReload(self):
-    # The renderable geometry...
+    # Let go of anything from before a reload...
+    self.releaseAssets()
+
+    # Request all of the models up front, so their loading overlaps with each other and with whatever else the manager is making...
     self.rend = None
+    self.colEgg = None
+    self.things = None
+
+    def rendCallback(model):
+      self.rend = model
+    def colCallback(model):
+      self.colEgg = model
+    def thingCallback(model):
+      self.things = model
+
+    # Balanced collision geometry is cached, as clusters in a bam keyed by the hash of the egg - if the cache exists we can skip the egg entirely. Without a layout the clusters are only used if cached, as making them during the transition takes longer than the egg layout...
+    colCache = None
+    colCached = False
+    colLayout = self.colLayout
+    if self.colPath!=None and colLayout!='egg':
+      colFile = findModelFile(self.colPath)
+      if colFile!=None:
+        colCache = odeSpaceHier.clusterCacheFile(self.cacheDir,colFile,self.colTriangles)
+        colCached = pfile.isfile(colCache)
+      if colLayout==None and not colCached:
+        colLayout = 'egg'
+
+    colLoad = None
+    if self.colPath!=None:
+      if colCached:
+        colLoad = colCache
+      else:
+        colLoad = self.colPath
+
+    for filename,callback in ((self.rendPath,rendCallback),(colLoad,colCallback),(self.thingPath,thingCallback)):
+      if filename!=None:
+        self.assetFiles.append(filename)
+        self.assets.loadModel(filename, callback=callback)
+
+    # The renderable geometry...
     if self.rendPath!=None:
-      def rendCallback(model):
-        self.rend = model
-      loader.loadModel(self.rendPath, callback=rendCallback)
       while self.rend==None:
-        time.sleep(0.05)
         yield
       
       # Let's hide it from the shadowcam for now.
@@ -92,17 +142,24 @@ class Level:
         yield
 
     # The collision geometry...
-    self.colEgg = None
     if self.colPath!=None:
-      def colCallback(model):
-        self.colEgg = model
-      loader.loadModel(self.colPath, callback=colCallback)
       while self.colEgg==None:
-        time.sleep(0.05)
         yield
 
       surfaceType = self.ode.getSurface(self.colSurface)
-      for r in odeSpaceHier.eggToOde(self.colEgg,surfaceType):
+      if colLayout=='egg':
+        build = odeSpaceHier.eggToOde(self.colEgg,surfaceType)
+      else:
+        if colCached:
+          clusters = self.colEgg
+        else:
+          for r in odeSpaceHier.balancedClusters(self.colEgg,self.colTriangles):
+            yield
+            clusters = r
+          if colCache!=None and clusters!=None:
+            odeSpaceHier.saveClusters(clusters,colCache)
+        build = odeSpaceHier.clustersToOde(clusters,surfaceType,self.colSpace)
+      for r in build:
         yield
         self.col = r
 
@@ -111,15 +168,16 @@ class Level:
       else:
         self.ode.getSpace().add(self.col)
 
+      # Only the ode version is needed from now on...
+      self.colEgg.removeNode()
+      self.colEgg = None
+      self.assetFiles.remove(colLoad)
+      self.assets.release(colLoad)
+
 
     # The thing egg...
-    self.things = None
     if self.thingPath!=None:
-      def thingCallback(model):
-        self.things = model
-      loader.loadModel(self.thingPath, callback=thingCallback)
       while self.things==None:
-        time.sleep(0.05)
         yield
 
 
@@ -130,9 +188,26 @@ class Level:
     if self.rend: self.rend.detachNode()
 
 
+  def releaseAssets(self):
+    """Internal use - removes the models and releases them back to the asset cache."""
+    if self.rend!=None:
+      self.rend.removeNode()
+      self.rend = None
+    if self.things!=None:
+      self.things.removeNode()
+      self.things = None
+    for filename in self.assetFiles:
+      self.assets.release(filename)
+    self.assetFiles = []
+
+
   def getThings(self):
     return self.things
 
+  def getThingsPath(self):
+    """Returns the path of the things file, as given to the loader, or None if there isn't one."""
+    return self.thingPath
+
   def getByIsA(self,name):
     """Given a name this returns a list of all objects in the things structure that have the tag IsA with the given name as the data. Will return an empty list if none available."""
     if self.things == None: return []
@@ -15,11 +15,14 @@
 
 from panda3d.core import *
 from direct.actor import Actor
+from direct.gui.DirectGui import DirectWaitBar
 
 
 class Loading:
   """Does a loading screen - renders some stuff whilst a transition is happenning."""
   def __init__(self,manager,xml):
+    self.manager = manager
+
     self.node = Actor.Actor('data/misc/loading')
     self.node.reparentTo(base.render)
     self.node.setShaderAuto()
@@ -31,6 +34,10 @@ class Loading:
     self.lightNode.setPos(0.0, 0.0, 1.5)
     self.node.setLight(self.lightNode)
 
+    # Progress bar, driven by the managers estimate of how far through the transition we are...
+    self.bar = DirectWaitBar(range = 100, value = 0, pos = (0.0,0.0,-0.85), scale = 0.5)
+    self.bar.hide()
+
     self.task = None
 
     #self.stop()
@@ -38,9 +45,13 @@ class Loading:
   def reload(self,manager,xml):
     pass
 
+  def destroy(self):
+    self.bar.destroy()
+
   def start(self):
     self.node.hide()
     self.node.stop()
+    self.bar.hide()
 
     if self.task!=None:
       taskMgr.remove(self.task)
@@ -49,9 +60,12 @@ class Loading:
   def stop(self):
     self.node.show()
     self.node.loop('slide')
+    self.bar['value'] = 0
+    self.bar.show()
     self.task = taskMgr.add(self.camPos, 'LoadingCamera')
 
   def camPos(self,task):
     base.camera.setPos(0.0,0.0,20.0)
     base.camera.lookAt(0.0,0.0,0.0)
+    self.bar['value'] = 100.0*self.manager.getPercentage()
     return task.cont
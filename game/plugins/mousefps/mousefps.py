@@ -59,6 +59,10 @@ class MouseFPS:
 
 
   def start(self):
+    # No mouse when rendering offscreen, e.g. for benchmarking...
+    if not isinstance(base.win,GraphicsWindow):
+      return
+
     # Get rid of the mouse cursor and go into relative mode.
     props = WindowProperties()
     props.setCursorHidden(True)
@@ -69,6 +73,9 @@ class MouseFPS:
     self.task = taskMgr.add(self.mouseTask,'Mouse',sort=-100)
 
   def stop(self):
+    if not isinstance(base.win,GraphicsWindow):
+      return
+
     # Re-enable the mouse cursor...
     props = WindowProperties()
     props.setCursorHidden(False)
@@ -18,29 +18,55 @@ import posixpath
 from panda3d.core import *
 from panda3d.ode import *
 
+from bin.shared.assets import getAssets
+
 
 class PhysicsObject:
   """Provides a simple physics object capability - replaces all of a specific IsA in a scene with a specific mesh and specific physics capabilities. Initialises such objects with simulation off, so they won't move until they itnteract with the player or an AI somehow - needed to restrict computation but means such objects must be positioned very accuratly in the level.
-  It can also contain a bunch of <instance> tags, that way you can specify positions yourself instead of doing it in the world model."""
+  It can also contain a bunch of <instance> tags, that way you can specify positions yourself instead of doing it in the world model.
+  Optionally a <cull plugin="cull"/> tag can be given, so the objects are moved between the cells of a CullAABB as they move, and get culled with them.
+  If an <instancing/> tag is given all of the meshes are drawn as one batch, using a RigidBodyCombiner, so the physics only has to update their transforms - good for objects that appear many times. As they then have to stay in the combiner this disables culling."""
   def __init__(self,manager,xml):
     self.reload(manager,xml)
     self.node = render.attachNewNode('PhysicsObjects')
     self.node.hide()
 
     self.things = [] # Tuple of (mesh,body,collider)
+    self.combiner = None # NodePath of the RigidBodyCombiner, when instancing.
+    self.triMesh = None # (ode plugin,filename) of the shared collision mesh, if any.
+    self.assetFiles = [] # Filenames obtained from the asset cache, to be released.
 
   def reload(self,manager,xml):
     self.manager = manager
     self.xml = xml
+    self.assets = getAssets(manager,xml)
+
+    cullElem = xml.find('cull')
+    if cullElem!=None:
+      self.cull = manager.get(cullElem.get('plugin','cull'))
+    else:
+      self.cull = None
 
   def destroy(self):
     for mesh,body,collider in self.things:
+      self.ode.unregDamping(body)
+      self.ode.unregBodySynch(mesh)
       mesh.removeNode()
       body.destroy()
       collider.destroy()
+    self.releaseAssets()
 
     self.node.removeNode()
 
+  def releaseAssets(self):
+    """Releases the shared collision mesh and the meshes obtained from the asset cache - must be called after everything using them has been destroyed."""
+    if self.triMesh!=None:
+      self.triMesh[0].releaseTriMeshData(self.triMesh[1])
+      self.triMesh = None
+    for filename in self.assetFiles:
+      self.assets.release(filename)
+    self.assetFiles = []
+
 
   def postInit(self):
     for i in self.postReload():
@@ -49,11 +75,17 @@ class PhysicsObject:
   def postReload(self):
     # We need to delete any old objects from before this reload...
     for mesh,body,collider in self.things:
+      self.ode.unregDamping(body)
+      self.ode.unregBodySynch(mesh)
       mesh.removeNode()
       body.destroy()
       collider.destroy()
       yield
     self.things = []
+    self.releaseAssets()
+    if self.combiner!=None:
+      self.combiner.removeNode()
+      self.combiner = None
     yield
     
     # Mesh path, physics plugin and physics type...
@@ -65,6 +97,12 @@ class PhysicsObject:
 
     pType = phys.get('type').lower()
 
+    # If instancing the meshes go into a combiner rather than directly under our node...
+    parent = self.node
+    if self.xml.find('instancing')!=None:
+      self.combiner = self.node.attachNewNode(RigidBodyCombiner('PhysicsObjectCombiner'))
+      parent = self.combiner
+
     # Find all instances of the object to obtain...
     toMake = []
     for isa in self.xml.findall('isa'):
@@ -75,36 +113,56 @@ class PhysicsObject:
     for inst in self.xml.findall('instance'):
       # Find <instance> tags that can be used to create instances of the physics object.
       make = NodePath('physicsObject')
-      make.setPos(  float(inst.get('x', '0')), float(inst.get('y', '0')), float(inst.get('z', '0')))
-      make.setHpr(  float(inst.get('h', '0')), float(inst.get('p', '0')), float(inst.get('r', '0')))
-      make.setScale(float(inst.get('sx','1')), float(inst.get('sy','1')), float(inst.get('sz','1')))
+      make.setPos(  inst.getFloat('x',0.0), inst.getFloat('y',0.0), inst.getFloat('z',0.0))
+      make.setHpr(  inst.getFloat('h',0.0), inst.getFloat('p',0.0), inst.getFloat('r',0.0))
+      make.setScale(inst.getFloat('sx',1.0), inst.getFloat('sy',1.0), inst.getFloat('sz',1.0))
       toMake.append(make)
       yield
 
+    # Request the meshes asynchronously, so their loading overlaps with the other objects being made - the loads for each instance below then come straight from the asset cache and model pool...
+    if len(toMake)!=0:
+      loaded = []
+      colLoaded = [] # Collision model, handed to the ode plugin so it doesn't load it again.
+      toLoad = 0
+      if self.xml.find('mesh')!=None:
+        filename = posixpath.join(basePath,self.xml.find('mesh').get('filename'))
+        self.assetFiles.append(filename)
+        self.assets.loadModel(filename, callback=loaded.append)
+        toLoad += 1
+      if pType=='mesh':
+        loader.loadModel(posixpath.join(basePath,phys.get('filename')), callback=colLoaded.append)
+        toLoad += 1
+
+      while len(loaded)+len(colLoaded)<toLoad:
+        yield
+
+    # Get the collision mesh, shared between all instances - its bounding box is used to calculate the inertial tensor...
+    if len(toMake)!=0 and pType=='mesh':
+      self.triMesh = (self.ode,posixpath.join(basePath,phys.get('filename')))
+      colTri = self.ode.getTriMeshData(self.triMesh[1],colLoaded[0])
+      low, high = self.ode.getTriMeshBounds(self.triMesh[1])
+
     # Make all of the relevant instances...
     for make in toMake:
       # Load the mesh, parent to render...
       filename = posixpath.join(basePath, self.xml.find('mesh').get('filename'))
-      model = loader.loadModel(filename)
-      model.reparentTo(self.node)
+      self.assetFiles.append(filename)
+      model = self.assets.loadModel(filename)
+      model.reparentTo(parent)
       model.setShaderAuto()
       model.setPosQuat(make.getPos(render),make.getQuat(render))
-        
-      if pType=='mesh':
-        # Need some way of calculating/obtaining an inertial tensor - currently using a box centered on the object with the dimensions of the collision meshes bounding axis aligned box...
-        colMesh = loader.loadModel(posixpath.join(basePath,phys.get('filename')))
 
       # Create the collision object...
       if pType=='sphere':
-        col = OdeSphereGeom(self.ode.getSpace(), float(phys.get('radius')))
+        col = OdeSphereGeom(self.ode.getSpace(), phys.getFloat('radius'))
       elif pType=='box':
-        col = OdeBoxGeom(self.ode.getSpace(), float(phys.get('lx')), float(phys.get('ly')), float(phys.get('lz')))
+        col = OdeBoxGeom(self.ode.getSpace(), phys.getFloat('lx'), phys.getFloat('ly'), phys.getFloat('lz'))
       elif pType=='cylinder':
-        col = OdeCylinderGeom(self.ode.getSpace(), float(phys.get('radius')), float(phys.get('height')))
+        col = OdeCylinderGeom(self.ode.getSpace(), phys.getFloat('radius'), phys.getFloat('height'))
       elif pType=='capsule':
-        col = OdeCappedCylinderGeom(self.ode.getSpace(), float(phys.get('radius')), float(phys.get('height')))
+        col = OdeCappedCylinderGeom(self.ode.getSpace(), phys.getFloat('radius'), phys.getFloat('height'))
       elif pType=='mesh':
-        col = OdeTriMeshGeom(self.ode.getSpace(), OdeTriMeshData(colMesh,True))
+        col = OdeTriMeshGeom(self.ode.getSpace(), colTri)
 
       col.setPosition(make.getPos(render))
       col.setQuaternion(make.getQuat(render))
@@ -119,16 +177,16 @@ class PhysicsObject:
       col.setBody(body)
       mass = OdeMass()
       if pType=='sphere':
-        mass.setSphereTotal(float(phys.get('mass')), float(phys.get('radius')))
+        mass.setSphereTotal(phys.getFloat('mass'), phys.getFloat('radius'))
       elif pType=='box':
-        mass.setBoxTotal(float(phys.get('mass')), float(phys.get('lx')), float(phys.get('ly')), float(phys.get('lz')))
+        mass.setBoxTotal(phys.getFloat('mass'), phys.getFloat('lx'), phys.getFloat('ly'), phys.getFloat('lz'))
       elif pType=='cylinder':
-        mass.setCylinderTotal(float(phys.get('mass')), 3, float(phys.get('radius')), float(phys.get('height')))
+        mass.setCylinderTotal(phys.getFloat('mass'), 3, phys.getFloat('radius'), phys.getFloat('height'))
       elif pType=='capsule':
-        mass.setCapsuleTotal(float(phys.get('mass')), 3, float(phys.get('radius')), float(phys.get('height')))
+        mass.setCapsuleTotal(phys.getFloat('mass'), 3, phys.getFloat('radius'), phys.getFloat('height'))
       elif pType=='mesh':
-        low, high = colMesh.getTightBounds()
-        mass.setBoxTotal(float(phys.get('mass')), high[0]-low[0], high[1]-low[1], high[2]-low[2])
+        # Need some way of calculating/obtaining an inertial tensor - currently using a box centered on the object with the dimensions of the collision meshes bounding axis aligned box...
+        mass.setBoxTotal(phys.getFloat('mass'), high[0]-low[0], high[1]-low[1], high[2]-low[2])
       else:
         raise Exception('Unrecognised physics type')
 
@@ -139,7 +197,7 @@ class PhysicsObject:
 
       damp = self.xml.find('damping')
       if damp!=None:
-        self.ode.regDamping(body,float(damp.get('linear')),float(damp.get('angular')))
+        self.ode.regDamping(body,damp.getFloat('linear'),damp.getFloat('angular'))
 
       # Tie everything together...
       self.ode.regBodySynch(model,body)
@@ -147,9 +205,19 @@ class PhysicsObject:
 
       yield
 
+    # Merge the instances into batches - from now on moving them only updates a transform table...
+    if self.combiner!=None:
+      self.combiner.node().collect()
+
     
   def start(self):
     self.node.show()
+    if self.cull and self.combiner==None:
+      for mesh,body,collider in self.things:
+        self.cull.cullDynamic(mesh,body)
 
   def stop(self):
     self.node.hide()
+    if self.cull and self.combiner==None:
+      for mesh,body,collider in self.things:
+        self.cull.uncullDynamic(mesh)
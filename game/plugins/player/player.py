@@ -65,11 +65,11 @@ class Player:
     # Get the players dimensions...
     size = xml.find('size')
     if size!=None:
-      self.height = float(size.get('height',1.55))
-      self.crouchHeight = float(size.get('crouchHeight',0.7))
-      self.radius = float(size.get('radius', 0.3))
-      self.headHeight = float(size.get('headHeight',1.4))
-      self.crouchHeadHeight = float(size.get('crouchHeadHeight',0.6))
+      self.height = size.getFloat('height',1.55)
+      self.crouchHeight = size.getFloat('crouchHeight',0.7)
+      self.radius = size.getFloat('radius',0.3)
+      self.headHeight = size.getFloat('headHeight',1.4)
+      self.crouchHeadHeight = size.getFloat('crouchHeadHeight',0.6)
     else:
       self.height = 1.55
       self.crouchHeight = 0.7
@@ -80,11 +80,11 @@ class Player:
     # Get the players power...
     power = xml.find('power')
     if power!=None:
-      self.playerBaseImpulse = float(power.get('baseImpulse',15000.0))
-      self.playerImpulse = float(power.get('feetImpulse',75000.0))
-      self.crouchSpeed = float(power.get('crouchSpeed',4.0))
-      self.jumpForce = float(power.get('jumpForce',16000.0))
-      self.jumpThreshold = float(power.get('jumpLeeway',0.1))
+      self.playerBaseImpulse = power.getFloat('baseImpulse',15000.0)
+      self.playerImpulse = power.getFloat('feetImpulse',75000.0)
+      self.crouchSpeed = power.getFloat('crouchSpeed',4.0)
+      self.jumpForce = power.getFloat('jumpForce',16000.0)
+      self.jumpThreshold = power.getFloat('jumpLeeway',0.1)
     else:
       self.playerBaseImpulse = 15000.0 # Always avaliable - air control.
       self.playerImpulse = 75000.0 # Only when on ground
@@ -95,8 +95,8 @@ class Player:
     # Get the players mass and terminal velocity...
     body = xml.find('body')
     if body!=None:
-      self.mass = float(body.get('mass',70.0))
-      self.airResistance = 9.8/(float(body.get('mass',30.0))**2.0)
+      self.mass = body.getFloat('mass',70.0)
+      self.airResistance = 9.8/(body.getFloat('mass',30.0)**2.0)
     else:
       self.mass = 70.0
       self.airResistance = 9.8/(30.0**2.0)
@@ -227,25 +227,31 @@ class Player:
     return task.cont
 
 
+  # Records the controls - the target velocity in feet and the facing direction of neck - for the physics to use, as it can't read nodes when running on its own thread. Runs late, so whatever sets the controls this frame has done so...
+  def controlsTask(self,task):
+    self.controls = (Vec3(self.feet.getPos()),Quat(self.neck.getQuat()))
+    return task.cont
+
+
   def playerPrePhysics(self):
     # Get the stuff we need - current velocity, target velocity and length of time step...
     vel = self.body.getLinearVel()
-    targVel = self.feet.getPos()
+    targVel = Vec3(self.controls[0])
     dt = self.ode.getDt()
 
     # Check if the player is standing still or moving - if moving try and obtain the players target velocity, otherwsie try to stand still, incase the player is on a slope and otherwise liable to slide (Theres a threshold to keep behaviour nice - slope too steep and you will slide.)...
     if targVel.lengthSquared()<1e-2 and vel.lengthSquared()<1e-1:
       # Player standing still - head for last standing position...
-      targVel = self.targPos - self.stomach.getPos()
+      targVel = self.targPos - self.body.getPosition()
       targVel /= 0.1 # Restoration time
       targVel[2] = 0.0 # Otherwise a vertical drop onto a slope can causes the player to do mini jumps to try and recover (!).
     else:
       # Player moving - use targVel and update last standing position...
-      self.targPos = self.stomach.getPos()
+      self.targPos = self.body.getPosition()
 
       # Rotate the target velocity to account for the players facing direction...
       rot = Mat3()
-      self.neck.getQuat().extractToMatrix(rot)
+      self.controls[1].extractToMatrix(rot)
       targVel = rot.xformVecGeneral(targVel)
 
 
@@ -321,7 +327,9 @@ class Player:
     self.body.setQuaternion(Quat())
     self.body.setAngularVel(Vec3(0.0,0.0,0.0))
     
-    # Update the panda node position to match the ode body position...
+    # Update the panda node position to match the ode body position - in threaded mode this is on the physics thread, so it is left to the synch of the body instead...
+    if self.ode.isThreaded():
+      return
     pp = self.body.getPosition() + self.body.getLinearVel()*self.ode.getRemTime() # Interpolation from physics step for smoother movement - due to physics being on a constant frame rate.
     self.stomach.setPos(render,pp)
 
@@ -342,6 +350,9 @@ class Player:
     
     # Arrange all the tasks/callbacks required...
     self.task = taskMgr.add(self.playerTask, 'PlayerTask')
+    self.controlTask = taskMgr.add(self.controlsTask, 'PlayerControls', sort=40) # Before the physics, in either mode.
+    if self.ode.isThreaded():
+      self.ode.regBodySynch(self.stomach, self.body)
     self.ode.regPreFunc('playerPrePhysics', self.playerPrePhysics)
     self.ode.regPostFunc('playerPostPhysics', self.playerPostPhysics)
 
@@ -352,6 +363,9 @@ class Player:
 
   def stop(self):
     taskMgr.remove(self.task)
+    taskMgr.remove(self.controlTask)
+    if self.ode.isThreaded():
+      self.ode.unregBodySynch(self.stomach)
     self.ode.unregPreFunc('playerPrePhysics')
     self.ode.unregPostFunc('playerPostPhysics')
 
@@ -374,7 +388,8 @@ class Player:
     self.body.setPosition(self.stomach.getPos(render))
     self.body.setLinearVel(Vec3(0.0,0.0,0.0))
 
-    self.targPos = self.stomach.getPos()
+    self.targPos = self.body.getPosition()
+    self.controls = (Vec3(self.feet.getPos()),Quat(self.neck.getQuat()))
 
 
   def crouch(self):
@@ -19,7 +19,10 @@ from direct.gui.DirectGui import *
 class QuickMenu:
   """This creates a menu - nothing fancy - just a list of buttons, each of which invokes a transition to another config file."""
   def __init__(self,manager,xml):
+    self.manager = manager
     self.buttons = []
+    self.targets = []
+    self.prefetched = set()
 
     # Create the button objects...
     yPos = 0.8
@@ -28,6 +31,9 @@ class QuickMenu:
       yPos -= 0.1
       button['command'] = manager.transition
       button['extraArgs'] = [but.get('target','')]
+      button.bind(DGG.ENTER,self.hover,[but.get('target','')])
+      if but.get('target','')!='':
+        self.targets.append(but.get('target'))
       button.hide()
       self.buttons.append(button)
 
@@ -35,6 +41,16 @@ class QuickMenu:
     for button in self.buttons:
       button.show()
 
+    # Whilst the user decides get the plugins of every option imported, so the transition doesn't have to...
+    for target in self.targets:
+      self.manager.preImport(target)
+
+  def hover(self,target,event):
+    """When the mouse goes over a button start loading the assets of its config, so if it is clicked the transition is quick."""
+    if target!='' and target not in self.prefetched:
+      self.prefetched.add(target)
+      self.manager.prefetch(target)
+
   def stop(self):
     for button in self.buttons:
       button.hide()
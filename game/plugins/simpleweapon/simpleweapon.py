@@ -71,7 +71,8 @@ class SimpleWeapon:
     self.gunView.reparentTo(manager.get(parent.get('plugin')).getNode(parent.get('node')))
 
     # Create a ray cast to detect what the player is looking at... and what will be shot...
-    self.space = manager.get('ode').getSpace()
+    self.ode = manager.get('ode')
+    self.space = self.ode.getSpace()
 
     if self.ray!=None:
       self.ray.destroy()
@@ -189,8 +190,7 @@ class SimpleWeapon:
           d *= force
 
           # If the object is asleep awaken it...
-          if not body.isEnabled():
-            body.enable()
+          self.ode.wake(body)
 
           # Add the force to the object...
           body.addForceAtPos(d,pos)
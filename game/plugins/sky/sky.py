@@ -16,6 +16,8 @@
 import posixpath
 from panda3d.core import Vec3, Vec4, BitMask32, TransparencyAttrib
 
+from bin.shared.assets import getAssets
+
 class Sky:
   """This loads a skydome/box/whatever the user specified."""
   def __init__(self,manager,xml):
@@ -29,10 +31,14 @@ class Sky:
     # Get the path to load skies from...
     basePath = manager.get('paths').getConfig().find('skies').get('path')
     
+    self.assets = getAssets(manager,xml)
+    self.assetFiles = [] # Filenames obtained from the asset cache, to be released.
+
     self.model = None
     skydome = xml.find('skydome')
     if skydome != None:
-      self.model = loader.loadModel(posixpath.join(basePath, 'skydome'))
+      self.assetFiles.append(posixpath.join(basePath, 'skydome'))
+      self.model = self.assets.loadModel(self.assetFiles[-1])
       self.model.setLightOff(1)
       self.model.setShaderOff(1)
       self.model.setCompass()
@@ -40,11 +46,20 @@ class Sky:
       self.model.setDepthWrite(False)
       self.model.setDepthTest(False)
       self.model.setColor(1, 1, 1, 1)
-      self.model.setTexture(loader.loadTexture(posixpath.join(basePath, skydome.get('filename'))))
+      self.assetFiles.append(posixpath.join(basePath, skydome.get('filename')))
+      self.model.setTexture(self.assets.loadTexture(self.assetFiles[-1]))
       self.model.setTag('sun', 'True')
       self.model.reparentTo(base.cam)
       self.model.hide()
 
+  def destroy(self):
+    if self.model!=None:
+      self.model.removeNode()
+      self.model = None
+    for filename in self.assetFiles:
+      self.assets.release(filename)
+    self.assetFiles = []
+
   def start(self):
     if self.bgColour!=None: base.setBackgroundColor(self.bgColour)
 
@@ -18,19 +18,26 @@ import posixpath
 from panda3d.core import *
 from panda3d.ode import *
 
+from bin.shared.assets import getAssets
+
 
 class StaticObject:
-  """Replaces all of a specific IsA in a scene with a specific mesh, including collision detection. It can also contain a bunch of <instance> tags, that way you can specify positions yourself instead of doing it in the world model."""
+  """Replaces all of a specific IsA in a scene with a specific mesh, including collision detection. It can also contain a bunch of <instance> tags, that way you can specify positions yourself instead of doing it in the world model.
+  If an <instancing/> tag is given the meshes are merged into a single batch per culling cell, or one in total if not culled, which greatly reduces the draw calls for objects that appear many times."""
   def __init__(self,manager,xml):
     self.reload(manager,xml)
     self.node = render.attachNewNode('StaticObjects')
     self.node.hide()
 
     self.things = [] # Tuple of (mesh,collider)
+    self.batches = [] # Merged meshes, when instancing.
+    self.triMesh = None # (ode plugin,filename) of the shared collision mesh, if any.
+    self.assetFiles = [] # Filenames obtained from the asset cache, to be released.
 
   def reload(self,manager,xml):
     self.manager = manager
     self.xml = xml
+    self.assets = getAssets(manager,xml)
 
   def destroy(self):
     for mesh,collider in self.things:
@@ -38,9 +45,21 @@ class StaticObject:
         mesh.removeNode()
       if collider:
         collider.destroy()
+    for batch in self.batches:
+      batch.removeNode()
+    self.releaseAssets()
 
     self.node.removeNode()
 
+  def releaseAssets(self):
+    """Releases the shared collision mesh and the meshes obtained from the asset cache - must be called after everything using them has been destroyed."""
+    if self.triMesh!=None:
+      self.triMesh[0].releaseTriMeshData(self.triMesh[1])
+      self.triMesh = None
+    for filename in self.assetFiles:
+      self.assets.release(filename)
+    self.assetFiles = []
+
 
   def postInit(self):
     for i in self.postReload():
@@ -55,6 +74,10 @@ class StaticObject:
         collider.destroy()
       yield
     self.things = []
+    for batch in self.batches:
+      batch.removeNode()
+    self.batches = []
+    self.releaseAssets()
     yield
     
     # Mesh path, physics plugin and physics type...
@@ -85,18 +108,41 @@ class StaticObject:
     for inst in self.xml.findall('instance'):
       # Find <instance> tags that can be used to create instances of the physics object.
       make = NodePath('staticObject')
-      make.setPos(  float(inst.get('x', '0')), float(inst.get('y', '0')), float(inst.get('z', '0')))
-      make.setHpr(  float(inst.get('h', '0')), float(inst.get('p', '0')), float(inst.get('r', '0')))
-      make.setScale(float(inst.get('sx','1')), float(inst.get('sy','1')), float(inst.get('sz','1')))
+      make.setPos(  inst.getFloat('x',0.0), inst.getFloat('y',0.0), inst.getFloat('z',0.0))
+      make.setHpr(  inst.getFloat('h',0.0), inst.getFloat('p',0.0), inst.getFloat('r',0.0))
+      make.setScale(inst.getFloat('sx',1.0), inst.getFloat('sy',1.0), inst.getFloat('sz',1.0))
       toMake.append(make)
       yield
 
+    # Request the meshes asynchronously, so their loading overlaps with the other objects being made - the loads for each instance below then come straight from the asset cache and model pool...
+    if len(toMake)!=0:
+      loaded = []
+      colLoaded = [] # Collision model, handed to the ode plugin so it doesn't load it again.
+      toLoad = 0
+      if self.xml.find('mesh')!=None:
+        filename = posixpath.join(basePath,self.xml.find('mesh').get('filename'))
+        self.assetFiles.append(filename)
+        self.assets.loadModel(filename, callback=loaded.append)
+        toLoad += 1
+      if pType=='mesh':
+        loader.loadModel(posixpath.join(basePath,phys.get('filename')), callback=colLoaded.append)
+        toLoad += 1
+
+      while len(loaded)+len(colLoaded)<toLoad:
+        yield
+
+    # Get the collision mesh, shared between all instances...
+    if len(toMake)!=0 and pType=='mesh':
+      self.triMesh = (self.ode,posixpath.join(basePath,phys.get('filename')))
+      colTri = self.ode.getTriMeshData(self.triMesh[1],colLoaded[0])
+
     # Make all of the relevant instances...
     for make in toMake:
       if self.xml.find('mesh') != None:
         # Load the mesh, parent to render...
         filename = posixpath.join(basePath,self.xml.find('mesh').get('filename'))
-        model = loader.loadModel(filename)
+        self.assetFiles.append(filename)
+        model = self.assets.loadModel(filename)
         model.reparentTo(self.node)
         model.setShaderAuto()
       else:
@@ -104,16 +150,14 @@ class StaticObject:
 
       # Create the collision object...
       if pType=='sphere':
-        col = OdeSphereGeom(self.ode.getSpace(), float(phys.get('radius')))
+        col = OdeSphereGeom(self.ode.getSpace(), phys.getFloat('radius'))
       elif pType=='box':
-        col = OdeBoxGeom(self.ode.getSpace(), float(phys.get('lx')), float(phys.get('ly')), float(phys.get('lz')))
+        col = OdeBoxGeom(self.ode.getSpace(), phys.getFloat('lx'), phys.getFloat('ly'), phys.getFloat('lz'))
       elif pType=='cylinder':
-        col = OdeCylinderGeom(self.ode.getSpace(), float(phys.get('radius')), float(phys.get('height')))
+        col = OdeCylinderGeom(self.ode.getSpace(), phys.getFloat('radius'), phys.getFloat('height'))
       elif pType=='capsule':
-        col = OdeCappedCylinderGeom(self.ode.getSpace(), float(phys.get('radius')), float(phys.get('height')))
+        col = OdeCappedCylinderGeom(self.ode.getSpace(), phys.getFloat('radius'), phys.getFloat('height'))
       elif pType=='mesh':
-        colMesh = loader.loadModel(posixpath.join(basePath,phys.get('filename')))
-        colTri = OdeTriMeshData(colMesh,True)
         col = OdeTriMeshGeom(self.ode.getSpace(),colTri)
       elif pType=='plane':
         col = OdePlaneGeom(self.ode.getSpace(), 0.0,0.0,1.0,0.0)
@@ -145,6 +189,22 @@ class StaticObject:
 
       yield
 
+    # If instancing merge the meshes that share a parent, which is to say a culling cell, into a single batch...
+    if self.xml.find('instancing')!=None and self.xml.find('mesh')!=None:
+      groups = dict() # Parent key -> list of meshes
+      for model,col in self.things:
+        groups.setdefault(model.getParent().getKey(),[]).append(model)
+
+      for models in groups.itervalues():
+        batch = models[0].getParent().attachNewNode('StaticObjectBatch')
+        for model in models:
+          model.wrtReparentTo(batch)
+        batch.flattenStrong()
+        self.batches.append(batch)
+        yield
+
+      self.things = map(lambda t: (None,t[1]),self.things)
+
 
   def start(self):
     self.node.show()